@@ -0,0 +1,345 @@
+"""
+Benchmarks for the discount Python bindings
+
+The C shared object should be compiled first (see ``INSTALL``), then
+run all benchmarks with:
+
+    python benchmarks.py
+
+or just some of them, by name:
+
+    python benchmarks.py render_many
+"""
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import discount
+import discount.blocks
+import discount.cache
+import discount.corpus
+
+
+SAMPLE_DOCUMENT = '''\
+Heading
+=======
+
+A paragraph with *emphasis*, **strong emphasis**, `code` and a
+[link](http://example.com/ "Example").  Another [link][ref] follows.
+
+* first item
+* second item with <http://example.com/autolink>
+* third item
+
+> A blockquote spanning
+> two lines.
+
+    indented code block
+    spanning two lines
+
+[ref]: http://example.com/ref "Reference"
+'''
+
+
+BENCHMARKS = []
+
+
+def rewrite_link(url):
+    return 'http://cdn.example.com/%s' % url
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def report(label, count, seconds):
+    print '  %-32s %8d docs  %8.3fs  %10.1f docs/s' % (
+        label, count, seconds, count / seconds if seconds else 0.0
+    )
+
+
+@benchmark
+def render_many(count=20000):
+    """
+    Throughput of ``discount.render_many`` against a serial loop, for
+    each thread pool size up to the number of CPUs.
+    """
+    texts = [SAMPLE_DOCUMENT] * count
+
+    def serial():
+        for text in texts:
+            discount.Markdown(text).get_html_content()
+
+    report('serial Markdown()', count, timed(serial))
+
+    for workers in range(1, multiprocessing.cpu_count() + 1):
+        report(
+            'render_many(workers=%d)' % workers, count,
+            timed(list, discount.render_many(texts, workers=workers))
+        )
+
+
+@benchmark
+def corpus_renderer(count=20000):
+    """
+    Throughput of ``discount.corpus.CorpusRenderer`` with a link
+    callback, for each process pool size up to the number of CPUs.
+    """
+    texts = [SAMPLE_DOCUMENT] * count
+
+    for processes in range(1, multiprocessing.cpu_count() + 1):
+        renderer = discount.corpus.CorpusRenderer(
+            processes, rewrite_links_func=rewrite_link)
+        report(
+            'CorpusRenderer(processes=%d)' % processes, count,
+            timed(list, renderer.render(texts))
+        )
+        renderer.close()
+
+        for stats in sorted(renderer.worker_stats.values(),
+                            key=lambda stats: stats.pid):
+            print '    worker %-6d %8d docs  %10.1f docs/s' % (
+                stats.pid, stats.documents, stats.throughput)
+
+
+@benchmark
+def render_inline(count=100000):
+    """
+    Latency of ``discount.render_inline`` against ``Markdown`` for
+    short, single line strings.
+    """
+    texts = ['A *short* title with `code` and a [link](/a.html)'] * count
+
+    def markdown():
+        for text in texts:
+            discount.Markdown(text).get_html_content()
+
+    def inline():
+        for text in texts:
+            discount.render_inline(text)
+
+    report('Markdown()', count, timed(markdown))
+    report('render_inline()', count, timed(inline))
+    report('render_inline_many()', count,
+           timed(discount.render_inline_many, texts))
+
+
+@benchmark
+def memoized_callbacks(count=20000):
+    """
+    Throughput of ``Markdown`` with a link callback, called for every
+    link and wrapped in a ``MemoizedLinkCallback``.
+    """
+    texts = [SAMPLE_DOCUMENT] * count
+    memoized = discount.cache.MemoizedLinkCallback(rewrite_link)
+
+    def render(func):
+        for text in texts:
+            discount.Markdown(
+                text, rewrite_links_func=func).get_html_content()
+
+    report('rewrite_links_func', count, timed(render, rewrite_link))
+    report('MemoizedLinkCallback', count, timed(render, memoized))
+    print '    hit rate %.1f%%' % (memoized.stats()['hit_rate'] * 100)
+
+
+@benchmark
+def callback_setup(count=100000):
+    """
+    Cost of creating and compiling ``Markdown`` objects, with and
+    without link callbacks.
+    """
+    def create(**kwargs):
+        for _ in xrange(count):
+            discount.Markdown('[a](/a.html)', **kwargs)._get_compiled_doc()
+
+    report('no callbacks', count, timed(create))
+    report('rewrite_links_func', count,
+           timed(create, rewrite_links_func=rewrite_link))
+
+
+ALLOCATION_COUNTS = r'''
+import os, re, tempfile, discount
+from discount import libmarkdown
+
+libmarkdown.load()
+adump = getattr(libmarkdown._so, 'adump', None)
+if adump is None:
+    raise SystemExit('_discount.so was built without --enable-amalloc')
+
+renderer = discount.Renderer(rewrite_links_func=str.upper)
+texts = [%(text)r] * %(count)d
+%(code)s
+
+# adump() writes the counters to stderr.
+err = tempfile.TemporaryFile()
+saved = os.dup(2)
+os.dup2(err.fileno(), 2)
+adump()
+os.dup2(saved, 2)
+err.seek(0)
+counts = dict((kind, int(n)) for n, kind in
+              re.findall(r'^(\d+) (malloc|free|realloc)', err.read(), re.M))
+print counts.get('malloc', 0), counts.get('free', 0)
+'''
+
+
+@benchmark
+def allocations(count=1000):
+    """
+    Allocations made by Discount per render, for ``Markdown`` objects
+    freed by the garbage collector and for ``Renderer``, which frees
+    each document as soon as it is rendered and keeps per-thread
+    resources.  Needs ``_discount.so`` built with ``--enable-amalloc``.
+    """
+    env = dict(os.environ, AMALLOC_STATISTICS='1')
+    for label, code in [
+        ('Markdown()',
+         'for text in texts:\n'
+         '    discount.Markdown(text, rewrite_links_func=str.upper)'
+         '.get_html_content()'),
+        ('Renderer.render()',
+         'for text in texts:\n'
+         '    renderer.render(text)'),
+    ]:
+        process = subprocess.Popen(
+            [sys.executable, '-c', ALLOCATION_COUNTS % {
+                'text': SAMPLE_DOCUMENT, 'count': count, 'code': code}],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = process.communicate()
+        if process.returncode:
+            print '  %s' % err.strip().splitlines()[-1]
+            return
+
+        mallocs, frees = [int(n) for n in out.split()]
+        print '  %-32s %8.1f mallocs  %8.1f frees per render' % (
+            label, float(mallocs) / count, float(frees) / count)
+
+
+@benchmark
+def sharded(megabytes=50):
+    """
+    Time taken to render a single large document serially, and with
+    ``discount.blocks.render_sharded`` for each thread pool size up to
+    the number of CPUs.
+    """
+    text = SAMPLE_DOCUMENT * (megabytes * 1024 * 1024 / len(SAMPLE_DOCUMENT))
+
+    def serial():
+        discount.Markdown(text).get_html_content()
+
+    def report_time(label, seconds):
+        print '  %-32s %8.3fs  %10.1f MB/s' % (
+            label, seconds, megabytes / seconds)
+
+    report_time('Markdown()', timed(serial))
+    for workers in range(1, multiprocessing.cpu_count() + 1):
+        with discount.Renderer(workers=workers) as renderer:
+            report_time(
+                'render_sharded(workers=%d)' % workers,
+                timed(discount.blocks.render_sharded, text, renderer))
+
+
+def peak_rss(code):
+    # Peak memory only ever grows within a process, so each
+    # measurement is made in a fresh interpreter.
+    return int(subprocess.check_output([
+        sys.executable, '-c',
+        'import resource, discount\n%s\n'
+        'print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss' % code
+    ]).split()[-1])
+
+
+@benchmark
+def input_memory(megabytes=200):
+    """
+    Peak RSS when rendering a large ``bytearray``, copied to a string
+    first as was needed before, and passed to ``Markdown`` directly.
+    """
+    setup = 'data = bytearray(%r * %d)' % (
+        SAMPLE_DOCUMENT, megabytes * 1024 * 1024 / len(SAMPLE_DOCUMENT))
+
+    for label, code in [
+        ('baseline (no rendering)', setup),
+        ('Markdown(str(bytearray))',
+         setup + '\ndiscount.Markdown(str(data)).get_html_content_buffer()'),
+        ('Markdown(bytearray)',
+         setup + '\ndiscount.Markdown(data).get_html_content_buffer()'),
+    ]:
+        print '  %-32s %10d KB peak RSS' % (label, peak_rss(code))
+
+
+@benchmark
+def large_file(megabytes=200):
+    """
+    Throughput and peak RSS when rendering a large file, from a file
+    object and with ``Markdown.from_path``.
+    """
+    fd, path = tempfile.mkstemp(suffix='.md')
+    fp = os.fdopen(fd, 'wb')
+    for _ in xrange(megabytes * 1024 * 1024 / len(SAMPLE_DOCUMENT)):
+        fp.write(SAMPLE_DOCUMENT)
+    fp.close()
+
+    try:
+        for label, code in [
+            ('Markdown(open(path))',
+             'discount.Markdown(open(%r)).get_html_content_buffer()' % path),
+            ('Markdown.from_path(path)',
+             'discount.Markdown.from_path(%r).get_html_content_buffer()' % (
+                 path)),
+        ]:
+            start = time.time()
+            rss = peak_rss(code)
+            seconds = time.time() - start
+            print '  %-32s %8.3fs %10.1f MB/s %10d KB peak RSS' % (
+                label, seconds, megabytes / seconds, rss)
+    finally:
+        os.remove(path)
+
+
+@benchmark
+def import_time(count=20):
+    """
+    Time taken by ``import discount``, and by the first render after
+    it, in a fresh interpreter.
+    """
+    code = (
+        'import time\n'
+        'start = time.time()\n'
+        'import discount\n'
+        'imported = time.time()\n'
+        'discount.Markdown("`test`").get_html_content()\n'
+        'print imported - start, time.time() - imported'
+    )
+    totals = [0.0, 0.0]
+    for _ in range(count):
+        out = subprocess.check_output([sys.executable, '-c', code])
+        for i, seconds in enumerate(out.split()):
+            totals[i] += float(seconds)
+
+    print '  %-32s %8.2f ms' % ('import discount', totals[0] / count * 1000)
+    print '  %-32s %8.2f ms' % ('first render', totals[1] / count * 1000)
+
+
+def main(names):
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        print '%s:' % func.__name__
+        func()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -21,11 +21,37 @@ docstrings for ``libmarkdown`` if you want to use the C functions
 directly.
 """
 
+import contextlib
 import ctypes
+import functools
+import hashlib
+import importlib
+import itertools
+import mmap
+import os
+import sys
+import threading
 
 import libmarkdown
 
 
+class _LazyModule(object):
+    # A submodule which is only imported when one of its attributes is
+    # first used, so that ``import discount`` stays cheap.  Importing
+    # it replaces this object in the package namespace.
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module('%s.%s' % (__name__, self._name))
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+
+cache = _LazyModule('cache')
+tree = _LazyModule('tree')
+
+
 _KWARGS_TO_LIBMARKDOWN_FLAGS = {
     'toc': libmarkdown.MKD_TOC,
     'strict': libmarkdown.MKD_STRICT,
@@ -41,12 +67,41 @@ _KWARGS_TO_LIBMARKDOWN_FLAGS = {
 }
 
 
+def _kwargs_to_flags(kwargs):
+    # Convert a ``kwargs`` dict to a bitmask of libmarkdown flags.
+    # All but one flag is exposed; MKD_1_COMPAT, which, according
+    # to the original documentation, is not really useful other
+    # than running MarkdownTest_1.0
+    flags = 0
+    for key in kwargs:
+        flags |= _KWARGS_TO_LIBMARKDOWN_FLAGS.get(key, 0)
+    return flags
+
+
+# Tag registrations made with ``add_html5_tags()`` and ``define_tag()``,
+# in the order they were made, so they can be replayed in other
+# processes.  Discount keeps a pointer to the tag name rather than a
+# copy, so this also keeps the strings alive.
+_tag_registrations = []
+
+
+def _replay_tag_registrations(registrations):
+    for registration in registrations:
+        if registration in _tag_registrations:
+            continue
+        if registration[0] == 'html5':
+            add_html5_tags()
+        else:
+            define_tag(*registration[1:])
+
+
 def add_html5_tags():
     """
     Adds (globally, and non-removably) a handful of new tags for html5
     support.
     """
     libmarkdown.mkd_with_html5_tags()
+    _tag_registrations.append(('html5',))
 
 
 def define_tag(tag, selfclose=False):
@@ -57,6 +112,7 @@ def define_tag(tag, selfclose=False):
 
     cp = ctypes.c_char_p(tag)
     libmarkdown.mkd_define_tag(cp, _selfclose)
+    _tag_registrations.append(('tag', tag, bool(selfclose)))
 
 
 class MarkdownError(Exception):
@@ -68,6 +124,355 @@ class MarkdownError(Exception):
         return '%s failure' % self.args[0]
 
 
+# Size of the strings passed to ``write()`` by the ``write_html_*()``
+# methods of ``Markdown``, when not writing to a real file.
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def _write_fd(fd, data):
+    while data:
+        data = buffer(data, os.write(fd, data))
+
+
+@contextlib.contextmanager
+def _buffer_pointer(obj, writable=False):
+    # Yield the address and size of the memory behind a buffer
+    # protocol object, without copying it.  Objects like ``mmap`` only
+    # support the old-style buffer protocol.
+    view = libmarkdown.Py_buffer()
+    try:
+        ctypes.pythonapi.PyObject_GetBuffer(
+            obj, ctypes.byref(view),
+            libmarkdown.PyBUF_WRITABLE if writable else libmarkdown.PyBUF_SIMPLE
+        )
+    except TypeError:
+        address = ctypes.c_void_p()
+        size = ctypes.c_ssize_t()
+        if writable:
+            ctypes.pythonapi.PyObject_AsWriteBuffer(
+                obj, ctypes.byref(address), ctypes.byref(size))
+        else:
+            ctypes.pythonapi.PyObject_AsReadBuffer(
+                obj, ctypes.byref(address), ctypes.byref(size))
+        yield address.value, size.value
+    else:
+        try:
+            yield view.buf, view.len
+        finally:
+            ctypes.pythonapi.PyBuffer_Release(ctypes.byref(view))
+
+
+def _render_html_content(text, flags, sb=None):
+    # Compile and generate a string in one go, without the
+    # bookkeeping of a ``Markdown`` instance.  Only foreign calls are
+    # made between ``mkd_string`` and ``mkd_cleanup``, so ctypes
+    # releases the GIL for nearly all of the work.
+    doc = libmarkdown.mkd_string(ctypes.c_char_p(text), len(text), flags)
+    try:
+        ret = libmarkdown.mkd_compile(doc, flags)
+        if ret == -1:
+            raise MarkdownError('mkd_compile')
+
+        if sb is None:
+            sb = ctypes.c_char_p()
+        ln = libmarkdown.mkd_document(doc, ctypes.byref(sb))
+        if ln == -1:
+            raise MarkdownError('mkd_document')
+        return ctypes.string_at(sb, ln) if ln > 0 else ''
+    finally:
+        libmarkdown.mkd_cleanup(doc)
+
+
+def render_many(texts, workers=None, chunksize=16, **kwargs):
+    """
+    Convert an iterable of Markdown strings to HTML using a pool of
+    ``workers`` threads (defaults to the number of CPUs).
+
+    Returns an iterator over the HTML output, in the same order as
+    ``texts``; results are yielded as soon as they are ready.  The
+    boolean keyword arguments accepted by ``Markdown`` are also
+    accepted here and apply to every document.
+
+    Since ctypes releases the GIL while Discount is running, the
+    documents are rendered in parallel.
+    """
+    # Imported here, as it is slow to import and only needed here.
+    import multiprocessing.pool
+
+    flags = _kwargs_to_flags(kwargs)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    # Discount sets up its global tables on first use; do that here,
+    # once, rather than racing on it from the worker threads.
+    libmarkdown.mkd_initialize()
+
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        render = functools.partial(_render_html_content, flags=flags)
+        for html in pool.imap(render, texts, chunksize):
+            yield html
+    finally:
+        pool.terminate()
+
+
+def _render_inline(text, flags, sb):
+    # ``mkd_line`` returns a buffer allocated with ``malloc``, or
+    # ``-1`` and a null pointer when there is no output at all.
+    ln = libmarkdown.mkd_line(text, len(text), ctypes.byref(sb), flags)
+    address = ctypes.cast(sb, ctypes.c_void_p).value
+    if address is None:
+        return ''
+    try:
+        return ctypes.string_at(address, ln) if ln > 0 else ''
+    finally:
+        libmarkdown.free(address)
+
+
+def render_inline(text, **kwargs):
+    """
+    Convert a single line of Markdown to HTML, without any block
+    level processing; no paragraph, list or header is generated.
+
+    This is a lot faster than ``Markdown`` for short strings like
+    titles or tooltips.  The boolean keyword arguments accepted by
+    ``Markdown`` are also accepted here.
+
+        >>> render_inline('*test*')
+        '<em>test</em>'
+    """
+    return _render_inline(
+        text, _kwargs_to_flags(kwargs), ctypes.c_char_p())
+
+
+def render_inline_many(texts, **kwargs):
+    """
+    Convert a list of single lines of Markdown to a list of HTML
+    strings, like ``render_inline()``.
+    """
+    flags = _kwargs_to_flags(kwargs)
+    sb = ctypes.c_char_p()
+    return [_render_inline(text, flags, sb) for text in texts]
+
+
+class _ChunkedInput(object):
+    # Input made of an iterable of strings, fed to ``mkd_in`` through
+    # a pipe while they are produced.  The iterable can only be read
+    # once, so an error reading it is raised again on later attempts,
+    # rather than compiling whatever is left of it.
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.error = None
+
+    def _feed(self, fd, errors):
+        try:
+            try:
+                for chunk in self.chunks:
+                    _write_fd(fd, chunk)
+            finally:
+                os.close(fd)
+        except:
+            errors.append(sys.exc_info())
+
+    def read_document(self, flags):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+        r, w = os.pipe()
+        fp = libmarkdown.fdopen(r, 'r')
+        if not fp:
+            os.close(r)
+            os.close(w)
+            raise MarkdownError('fdopen')
+
+        errors = []
+        feeder = threading.Thread(target=self._feed, args=(w, errors))
+        feeder.daemon = True
+        feeder.start()
+        try:
+            doc = libmarkdown.mkd_in(fp, flags)
+        finally:
+            libmarkdown.fclose(fp)
+            feeder.join()
+
+        if errors:
+            libmarkdown.mkd_cleanup(doc)
+            self.error = errors[0]
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return doc
+
+
+class _CallbackArena(object):
+    # Storage for link callback results during a single render.
+    #
+    # Discount copies a callback result into its output as soon as the
+    # callback returns, so results are carved one after the other out
+    # of a single block, grown by doubling when it runs out of room.
+    # ``reset()`` is called once the output is generated; it drops the
+    # results and any outgrown blocks, keeping one block of at most
+    # ``max_retained`` bytes for the next render.
+    def __init__(self, size=4096, max_retained=1024 * 1024):
+        self.size = size
+        self.max_retained = max_retained
+        self._block = None
+        self._offset = 0
+        self._retired = []
+        self._pinned = []
+
+    def carve(self, data):
+        """
+        Copy ``data`` into the arena, null-terminated, and return its
+        address.
+        """
+        needed = len(data) + 1
+        block = self._block
+        if block is None or self._offset + needed > len(block):
+            size = self.size
+            if block is not None:
+                # Earlier results may still be pointed to until reset.
+                self._retired.append(block)
+                size = len(block) * 2
+            block = self._block = ctypes.create_string_buffer(
+                max(size, needed))
+            self._offset = 0
+
+        address = ctypes.addressof(block) + self._offset
+        ctypes.memmove(address, data, len(data))
+        block[self._offset + len(data)] = '\0'
+        self._offset += needed
+        return address
+
+    def pin(self, buf):
+        """
+        Keep ``buf``, a buffer owned by someone else, alive until the
+        next reset and return its address.
+        """
+        self._pinned.append(buf)
+        return ctypes.addressof(buf)
+
+    def reset(self):
+        self._retired = []
+        self._pinned = []
+        self._offset = 0
+        if self._block is not None and len(self._block) > self.max_retained:
+            self._block = None
+
+
+# Link callbacks of the documents being rendered, keyed on the handle
+# passed to Discount with ``mkd_e_data``.  Each entry holds the
+# ``rewrite_links_func`` and ``link_attrs_func`` callbacks, as returned
+# by ``_link_callback()``, and the arena of a single ``Markdown``
+# object, and is removed when the object is deleted.
+_link_callbacks = {}
+_link_callback_handles = itertools.count(1)
+
+
+def _link_callback(func):
+    # Return the function to call for each link, and whether it returns
+    # a buffer to pin rather than a string to copy.  This is decided
+    # once per document, rather than once per link.
+    if func is None:
+        return None
+    if isinstance(func, cache.MemoizedLinkCallback):
+        return func.buffer_for, True
+    return func, False
+
+
+def _link_callback_result(callback, arena, url):
+    func, shared = callback
+    ret = func(url)
+    if ret is None:
+        return None
+    if shared:
+        # The buffer is shared with other documents; it's pinned so it
+        # outlives this render even if it is evicted in the meantime.
+        return arena.pin(ret)
+    return arena.carve(ret)
+
+
+# The same two C functions serve every document, so creating a
+# ``Markdown`` object with callbacks doesn't create any.
+@libmarkdown.e_url_callback
+def _rewrite_links_thunk(string, size, handle):
+    rewrite_links_callback, _, arena = _link_callbacks[handle]
+    return _link_callback_result(
+        rewrite_links_callback, arena, string[:size])
+
+
+@libmarkdown.e_flags_callback
+def _link_attrs_thunk(string, size, handle):
+    _, link_attrs_callback, arena = _link_callbacks[handle]
+    return _link_callback_result(link_attrs_callback, arena, string[:size])
+
+
+class _CompiledDocument(object):
+    # Owner of a compiled document.  The ``Markdown`` object that
+    # compiled it holds one reference, and so does everything handed
+    # out which points into Discount's buffers, so the document is
+    # only freed once all of them are gone, even after ``close()``.
+    __slots__ = ('doc',)
+
+    def __init__(self, doc):
+        self.doc = doc
+
+    def __del__(self):
+        try:
+            libmarkdown.mkd_cleanup(self.doc)
+        except AttributeError:
+            # The module may already be torn down at interpreter exit.
+            pass
+
+
+# Output functions which return a buffer allocated with ``malloc`` for
+# the caller to free, rather than one owned by the document.
+_MALLOCED_OUTPUT = frozenset(['mkd_toc', 'mkd_css'])
+
+
+def _free_output(address, name):
+    if address is not None and name in _MALLOCED_OUTPUT:
+        libmarkdown.free(address)
+
+
+class RenderResult(object):
+    """
+    All the parts of a rendered document, as returned by
+    ``Markdown.render()``.
+
+    ``content``, ``toc`` and ``css`` are the same as the output of the
+    ``get_html_*()`` methods of ``Markdown``, and ``title``, ``author``
+    and ``date`` the same as the output of the ``get_pandoc_*()``
+    methods.  The content is copied out of Discount's buffer the first
+    time it is accessed.
+    """
+    __slots__ = ('_owner', '_buffers', 'title', 'author', 'date')
+
+    def __init__(self, owner, buffers, title, author, date):
+        # ``owner`` keeps the compiled document the buffers point into
+        # alive.
+        self._owner = owner
+        self._buffers = buffers
+        self.title = title
+        self.author = author
+        self.date = date
+
+    def _get(self, name):
+        value = self._buffers[name]
+        if not isinstance(value, str):
+            address, size = value
+            value = ctypes.string_at(address, size) if size > 0 else ''
+            self._buffers[name] = value
+        return value
+
+    content = property(lambda self: self._get('content'))
+    toc = property(lambda self: self._get('toc'))
+    css = property(lambda self: self._get('css'))
+
+    def __repr__(self):
+        return '<RenderResult title=%r author=%r date=%r>' % (
+            self.title, self.author, self.date)
+
+
 class Markdown(object):
     """
     Markdown to HTML conversion.
@@ -75,15 +480,25 @@ class Markdown(object):
     A single argument is required, ``input_file_or_string``, the
     Markdown formatted data.  If this argument is a file-like object,
     the file must be a real OS file descriptor, i.e. ``sys.stdin``
-    yes, a ``StringIO`` object, no.  The argument is otherwise assumed
-    to be a string-like object.  The same is true for ``Markdown``
-    methods that write HTML output to files.
+    yes, a ``StringIO`` object, no.  The argument is otherwise
+    assumed to be a string, or an object supporting the buffer
+    protocol, like ``bytearray``, ``memoryview`` or ``mmap``, whose
+    memory is read in place, without making a copy.
 
     Optionally, you can specify two callback functions,
     ``rewrite_links_func`` and ``link_attrs_func``, which are hooks
     when links are processed in the markdown document (See the
     ``rewrite_links()`` and ``link_attrs()`` methods).
 
+    The common cases, like prefix substitution or adding attributes to
+    external links, can instead be given as a ``links.LinkRules``
+    object, with the ``link_rules`` keyword argument.
+
+    A cache for the HTML output, such as a ``cache.RenderCache`` or a
+    ``cache.DiskCache``, can be given with the ``cache`` keyword
+    argument.  It is consulted by the ``get_html_*()`` methods when the
+    input is a string.
+
     Additional boolean keyword arguments are also accepted:
 
     ``toc`` : bool
@@ -137,24 +552,27 @@ class Markdown(object):
     with the ``get_html_css()``, ``get_html_toc()`` and
     ``get_html_content()`` methods, or written to a file with the
     ``write_html_css(fp)``, ``write_html_toc(fp)`` and
-    ``write_html_content(fp)`` methods, where ``fp`` is the output
-    file descriptor.
+    ``write_html_content(fp)`` methods, where ``fp`` is a file, any
+    object with a ``write()`` method, or a file descriptor.  Output
+    to anything but a real file is written in chunks of at most
+    ``WRITE_CHUNK_SIZE`` bytes, which ``iter_html_content()`` also
+    yields.
     """
     def __init__(
         self, input_file_or_string,
-        rewrite_links_func=None, link_attrs_func=None,
-        **kwargs):
+        rewrite_links_func=None, link_attrs_func=None, cache=None,
+        link_rules=None, **kwargs):
 
         self.input = input_file_or_string
+        self.flags = _kwargs_to_flags(kwargs)
+        self.cache = cache
 
-        # Convert a ``kwargs`` dict to a bitmask of libmarkdown flags.
-        # All but one flag is exposed; MKD_1_COMPAT, which, according
-        # to the original documentation, is not really useful other
-        # than running MarkdownTest_1.0
-        flags = 0
-        for key in kwargs:
-            flags |= _KWARGS_TO_LIBMARKDOWN_FLAGS.get(key, 0)
-        self.flags = flags
+        if link_rules is not None:
+            if rewrite_links_func is not None or link_attrs_func is not None:
+                raise TypeError(
+                    'link_rules cannot be combined with link callbacks')
+            rewrite_links_func = link_rules.rewrite_links_func
+            link_attrs_func = link_rules.link_attrs_func
 
         if rewrite_links_func is not None:
             self.rewrite_links(rewrite_links_func)
@@ -162,88 +580,255 @@ class Markdown(object):
         if link_attrs_func is not None:
             self.link_attrs(link_attrs_func)
 
-        self._alloc = []
+        self._arena = _CallbackArena()
 
     def __del__(self):
         try:
-            libmarkdown.mkd_cleanup(self._doc)
+            self.close()
         except AttributeError:
             pass
 
+    def close(self):
+        """
+        Free the compiled document now, rather than when the object is
+        garbage collected.
+
+        The object can't be used afterwards.  The results of
+        ``render()``, ``get_html_content_buffer()`` and
+        ``iter_html_content()`` point into the document, which is only
+        freed once they are gone too.
+        """
+        self._closed = True
+        self._close_input()
+        _link_callbacks.pop(getattr(self, '_link_callback_handle', None), None)
+        self.__dict__.pop('_doc', None)
+        self.__dict__.pop('_document', None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def from_chunks(cls, chunks, *args, **kwargs):
+        """
+        Create a ``Markdown`` object from an iterable of strings, like
+        a generator reading a request body or database rows.
+
+        The strings are passed on to Discount as they are produced,
+        without joining them, so the document is read into Discount in
+        a single copy.  The iterable is consumed, and the document
+        compiled, the first time the output is requested.
+
+        Other arguments are the same as for ``Markdown``.
+        """
+        return cls(_ChunkedInput(chunks), *args, **kwargs)
+
+    @classmethod
+    def from_path(cls, path, *args, **kwargs):
+        """
+        Create a ``Markdown`` object for the file at ``path``.
+
+        The file is memory-mapped rather than read through stdio, which
+        is faster and uses less memory for very large files.  The
+        mapping is closed as soon as the document has been read by
+        Discount, or when the object is deleted, whichever comes first.
+
+        Other arguments are the same as for ``Markdown``.
+        """
+        fp = open(path, 'rb')
+        try:
+            if os.fstat(fp.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                input_ = ''
+            else:
+                input_ = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+
+        md = cls(input_, *args, **kwargs)
+        md._owns_input = isinstance(input_, mmap.mmap)
+        return md
+
+    def _close_input(self):
+        if getattr(self, '_owns_input', False):
+            self._owns_input = False
+            self.input.close()
+
     def _get_compiled_doc(self):
         if not hasattr(self, '_doc'):
-            if hasattr(self.input, 'read'):
+            if getattr(self, '_closed', False):
+                raise ValueError('Markdown object is closed')
+
+            if isinstance(self.input, _ChunkedInput):
+                self._doc = self.input.read_document(self.flags)
+            elif (hasattr(self.input, 'read') and
+                  not isinstance(self.input, mmap.mmap)):
                 # If the input is file-like
                 input_ = ctypes.pythonapi.PyFile_AsFile(self.input)
                 self._doc = libmarkdown.mkd_in(input_, self.flags)
-            else:
-                # Otherwise, treat it as a string
+            elif isinstance(self.input, basestring):
+                # If the input is a string
                 input_ = ctypes.c_char_p(self.input)
                 self._doc = libmarkdown.mkd_string(
                     input_, len(self.input), self.flags)
-
+            else:
+                # Otherwise, hand the memory of the buffer object
+                # straight to Discount, which copies it into its own
+                # line structures.
+                with _buffer_pointer(self.input) as (address, size):
+                    input_ = ctypes.c_char_p(address or '')
+                    self._doc = libmarkdown.mkd_string(
+                        input_, size, self.flags)
+
+                # Nothing refers to the input after this point.
+                self._close_input()
+
+            self._document = _CompiledDocument(self._doc)
+
+            # The output depends on the flags the document is compiled
+            # with, which ``self.flags`` may no longer be.
+            self._compile_flags = self.flags
             ret = libmarkdown.mkd_compile(self._doc, self.flags)
 
             if ret == -1:
                 raise MarkdownError('mkd_compile')
 
-            if hasattr(self, '_rewrite_links_func'):
-                libmarkdown.mkd_e_url(self._doc, self._rewrite_links_func)
+            rewrite_links_func = getattr(self, '_rewrite_links_callback', None)
+            link_attrs_func = getattr(self, '_link_attrs_callback', None)
+
+            if rewrite_links_func is not None or link_attrs_func is not None:
+                handle = next(_link_callback_handles)
+                _link_callbacks[handle] = (
+                    _link_callback(rewrite_links_func),
+                    _link_callback(link_attrs_func),
+                    self._arena,
+                )
+                self._link_callback_handle = handle
+                libmarkdown.mkd_e_data(self._doc, handle)
 
-            if hasattr(self, '_link_attrs_func'):
-                libmarkdown.mkd_e_flags(self._doc, self._link_attrs_func)
+            if rewrite_links_func is not None:
+                libmarkdown.mkd_e_url(self._doc, _rewrite_links_thunk)
+
+            if link_attrs_func is not None:
+                libmarkdown.mkd_e_flags(self._doc, _link_attrs_thunk)
 
         return self._doc
 
+    def _cache_key(self, part):
+        if not hasattr(self, '_input_digest'):
+            self._input_digest = hashlib.sha1(self.input).hexdigest()
+
+        # Registering a tag changes how documents are parsed, so the
+        # registrations made so far are part of the key; they are the
+        # same in every process that made the same calls, unlike a
+        # counter.
+        return (
+            part, self._input_digest,
+            getattr(self, '_compile_flags', self.flags),
+            getattr(self, '_rewrite_links_callback', None),
+            getattr(self, '_link_attrs_callback', None),
+            tuple(_tag_registrations),
+            libmarkdown.markdown_version,
+        )
+
+    def _cached(self, part, generate):
+        if self.cache is None or not isinstance(self.input, basestring):
+            return generate()
+
+        key = self._cache_key(part)
+        html = self.cache.get(key)
+        if html is None:
+            html = generate()
+            self.cache.set(key, html)
+        return html
+
+    def _generate(self, func, *args):
+        # Link callbacks only run while Discount generates the output,
+        # and their results are not needed once it is done.
+        doc = self._get_compiled_doc()
+        try:
+            return func(doc, *args)
+        finally:
+            self._arena.reset()
+
+    def _get_buffer(self, func, name):
+        # Buffers to be freed start out null, so nothing is freed if
+        # Discount doesn't set them.
+        sb = ctypes.c_char_p(None if name in _MALLOCED_OUTPUT else '')
+        ln = self._generate(func, ctypes.byref(sb))
+        address = ctypes.cast(sb, ctypes.c_void_p).value
+        if ln == -1:
+            _free_output(address, name)
+            raise MarkdownError(name)
+        return address, ln
+
+    def _get_string(self, func, name):
+        # Copy exactly ``ln`` bytes; ``c_char_p.value`` would scan for
+        # the terminating null and copy the whole buffer first.
+        address, ln = self._get_buffer(func, name)
+        try:
+            return ctypes.string_at(address, ln) if ln > 0 else ''
+        finally:
+            _free_output(address, name)
+
+    def _iter_chunks(self, func, name, chunk_size):
+        address, ln = self._get_buffer(func, name)
+        # Keeps the document alive while the iterator is.
+        document = self._document
+        try:
+            for offset in xrange(0, max(ln, 0), chunk_size):
+                yield ctypes.string_at(
+                    address + offset, min(chunk_size, ln - offset))
+        finally:
+            _free_output(address, name)
+
+    def _write_chunks(self, fp, func, name, chunk_size=WRITE_CHUNK_SIZE):
+        if isinstance(fp, (int, long)):
+            write = functools.partial(_write_fd, fp)
+        else:
+            write = fp.write
+
+        for chunk in self._iter_chunks(func, name, chunk_size):
+            write(chunk)
+
     def _generate_html_content(self, fp=None):
-        if fp is not None:
+        if isinstance(fp, file):
             fp_ = ctypes.pythonapi.PyFile_AsFile(fp)
-            ret = libmarkdown.mkd_generatehtml(self._get_compiled_doc(), fp_)
+            ret = self._generate(libmarkdown.mkd_generatehtml, fp_)
             if ret == -1:
                 raise MarkdownError('mkd_generatehtml')
+        elif fp is not None:
+            self._write_chunks(fp, libmarkdown.mkd_document, 'mkd_document')
         else:
-            sb = ctypes.c_char_p('')
-            ln = libmarkdown.mkd_document(self._get_compiled_doc(), ctypes.byref(sb))
-            if ln == -1:
-                raise MarkdownError('mkd_document')
-            else:
-                return sb.value[:ln] if sb.value else ''
-        self._alloc = []
+            return self._get_string(libmarkdown.mkd_document, 'mkd_document')
 
     def _generate_html_toc(self, fp=None):
         self.flags |= libmarkdown.MKD_TOC
 
-        if fp is not None:
+        if isinstance(fp, file):
             fp_ = ctypes.pythonapi.PyFile_AsFile(fp)
-            ret = libmarkdown.mkd_generatetoc(self._get_compiled_doc(), fp_)
+            ret = self._generate(libmarkdown.mkd_generatetoc, fp_)
             if ret == -1:
                 raise MarkdownError('mkd_generatetoc')
+        elif fp is not None:
+            self._write_chunks(fp, libmarkdown.mkd_toc, 'mkd_toc')
         else:
-            sb = ctypes.c_char_p('')
-            ln = libmarkdown.mkd_toc(self._get_compiled_doc(), ctypes.byref(sb))
-            if ln == -1:
-                raise MarkdownError('mkd_toc')
-            else:
-                return sb.value[:ln] if sb.value else ''
-        self._alloc = []
+            return self._get_string(libmarkdown.mkd_toc, 'mkd_toc')
 
     def _generate_html_css(self, fp=None):
-        if fp is not None:
+        if isinstance(fp, file):
             fp_ = ctypes.pythonapi.PyFile_AsFile(fp)
-            ret = libmarkdown.mkd_generatecss(self._get_compiled_doc(), fp_)
+            ret = self._generate(libmarkdown.mkd_generatecss, fp_)
 
             # Returns -1 even on success
             # if ret == -1:
             #     raise MarkdownError('mkd_generatecss')
+        elif fp is not None:
+            self._write_chunks(fp, libmarkdown.mkd_css, 'mkd_css')
         else:
-            sb = ctypes.c_char_p('')
-            ln = libmarkdown.mkd_css(self._get_compiled_doc(), ctypes.byref(sb))
-
-            if ln == -1:
-                raise MarkdownError('mkd_css')
-            else:
-                return sb.value[:ln] if sb.value else ''
-        self._alloc = []
+            return self._get_string(libmarkdown.mkd_css, 'mkd_css')
 
     def rewrite_links(self, func):
         """
@@ -256,15 +841,7 @@ class Markdown(object):
         You can use this method as a decorator on the function you
         want to set as the callback.
         """
-        @libmarkdown.e_url_callback
-        def _rewrite_links_func(string, size, context):
-            ret = func(string[:size])
-            if ret is not None:
-                buf = ctypes.create_string_buffer(ret)
-                self._alloc.append(buf)
-                return ctypes.addressof(buf)
-
-        self._rewrite_links_func = _rewrite_links_func
+        self._rewrite_links_callback = func
         return func
 
     def link_attrs(self, func):
@@ -278,15 +855,7 @@ class Markdown(object):
         You can use this method as a decorator on the function you
         want to set as the callback.
         """
-        @libmarkdown.e_flags_callback
-        def _link_attrs_func(string, size, context):
-            ret = func(string[:size])
-            if ret is not None:
-                buf = ctypes.create_string_buffer(ret)
-                self._alloc.append(buf)
-                return ctypes.addressof(buf)
-
-        self._link_attrs_func = _link_attrs_func
+        self._link_attrs_callback = func
         return func
 
     def get_pandoc_title(self):
@@ -307,38 +876,357 @@ class Markdown(object):
         """
         return libmarkdown.mkd_doc_date(self._get_compiled_doc())
 
+    def get_tree(self):
+        """
+        Get the structure of the document, as a list of top-level
+        ``tree.Node`` objects, without generating any HTML.
+        """
+        return tree.build_tree(self._get_compiled_doc())
+
+    def get_flat_tree(self):
+        """
+        Get the structure of the document as a ``tree.FlatTree``, a
+        set of ``array.array`` columns, without generating any HTML.
+        """
+        return tree.build_flat_tree(self._get_compiled_doc())
+
+    def get_outline(self):
+        """
+        Get the headers of the table of contents, without generating
+        any HTML, as a list of ``(level, anchor_id, text)`` tuples.
+
+        ``anchor_id`` is the id of the header in the content rendered
+        with ``toc=True``, and ``text`` its Markdown source.
+        """
+        return tree.build_outline(self._get_compiled_doc())
+
+    def get_links(self):
+        """
+        Get the urls of the document, without generating any HTML, as
+        a list of ``tree.Link`` objects with their ``kind``, ``url``,
+        ``title``, image ``width`` and ``height`` and, for reference
+        definitions, ``label``.
+        """
+        return tree.build_links(self._get_compiled_doc(), self.flags)
+
+    def get_plain_text(self):
+        """
+        Get the visible text of the document, without any Markdown or
+        html markup, one block per line, without generating any HTML.
+        Suitable for full-text indexing.
+        """
+        return ''.join(tree.iter_plain_text(self._get_compiled_doc()))
+
     def get_html_content(self):
         """
         Get the document content as HTML.
         """
-        return self._generate_html_content()
+        return self._cached('content', self._generate_html_content)
 
     def get_html_toc(self):
         """
         Get the document's table of contents as HTML.
         """
-        return self._generate_html_toc()
+        # The flag is part of the cache key of every part, so it's set
+        # even when the table of contents comes from the cache.
+        self.flags |= libmarkdown.MKD_TOC
+        return self._cached('toc', self._generate_html_toc)
 
     def get_html_css(self):
         """
         Get any style blocks in the document as HTML.
         """
-        return self._generate_html_css()
+        return self._cached('css', self._generate_html_css)
+
+    def render(self):
+        """
+        Get the document content, table of contents, style blocks and
+        pandoc header elements all at once, as a ``RenderResult``.
+
+        The document is compiled a single time, with table-of-contents
+        headers enabled, so call this before any of the ``get_*()`` or
+        ``write_*()`` methods.
+        """
+        if not hasattr(self, '_doc'):
+            self.flags |= libmarkdown.MKD_TOC
+
+        # The content stays in the document until it is accessed; the
+        # table of contents and style blocks are allocated for the
+        # caller on each call, so they are copied and freed right away.
+        buffers = {
+            'content': self._get_buffer(
+                libmarkdown.mkd_document, 'mkd_document'),
+            'toc': self._get_string(libmarkdown.mkd_toc, 'mkd_toc'),
+            'css': self._get_string(libmarkdown.mkd_css, 'mkd_css'),
+        }
+
+        doc = self._get_compiled_doc()
+        return RenderResult(
+            self._document, buffers,
+            libmarkdown.mkd_doc_title(doc),
+            libmarkdown.mkd_doc_author(doc),
+            libmarkdown.mkd_doc_date(doc),
+        )
+
+    def get_html_content_buffer(self):
+        """
+        Get the document content as HTML, without copying it out of
+        Discount's output buffer.
+
+        Returns a ctypes character array supporting the buffer
+        protocol, i.e. ``memoryview(buf)`` and ``buf.raw`` both work.
+        The array keeps the document alive until it is dropped.
+        """
+        address, ln = self._get_buffer(
+            libmarkdown.mkd_document, 'mkd_document')
+
+        if ln > 0:
+            buf = (ctypes.c_char * ln).from_address(address)
+        else:
+            buf = (ctypes.c_char * 0)()
+        buf._document = self._document
+        return buf
+
+    def render_into(self, buf):
+        """
+        Write the document content as HTML into ``buf``, a writable
+        buffer such as a ``bytearray`` or a ``memoryview`` of one, and
+        return the number of bytes written.
+
+        Raises ``ValueError`` if ``buf`` is too small.
+        """
+        address, ln = self._get_buffer(
+            libmarkdown.mkd_document, 'mkd_document')
+
+        with _buffer_pointer(buf, writable=True) as (dest, size):
+            if ln > size:
+                raise ValueError(
+                    'buffer of %d bytes is too small for %d bytes of HTML' % (
+                        size, ln))
+            if ln > 0:
+                ctypes.memmove(dest, address, ln)
+        return max(ln, 0)
+
+    def iter_html_content(self, chunk_size=WRITE_CHUNK_SIZE):
+        """
+        Iterate over the document content as HTML, in strings of at
+        most ``chunk_size`` bytes.  The iterator can be returned as is
+        from a WSGI application.
+        """
+        return self._iter_chunks(
+            libmarkdown.mkd_document, 'mkd_document', chunk_size)
 
     def write_html_content(self, fp):
         """
-        Write the document content to the file, ``fp``.
+        Write the document content to ``fp``, a file, an object with a
+        ``write()`` method or a file descriptor.
         """
         self._generate_html_content(fp)
 
+    def write_plain_text(self, fp):
+        """
+        Write the visible text of the document, as returned by
+        ``get_plain_text()``, to ``fp``, a file, an object with a
+        ``write()`` method or a file descriptor, one block at a time.
+        """
+        if isinstance(fp, (int, long)):
+            write = functools.partial(_write_fd, fp)
+        else:
+            write = fp.write
+
+        for text in tree.iter_plain_text(self._get_compiled_doc()):
+            write(text)
+
     def write_html_toc(self, fp):
         """
-        Write the document's table of contents to the file, ``fp``.
+        Write the document's table of contents to ``fp``, a file, an
+        object with a ``write()`` method or a file descriptor.
         """
         self._generate_html_toc(fp)
 
     def write_html_css(self, fp):
         """
-        Write any style blocks in the document to the file, ``fp``.
+        Write any style blocks in the document to ``fp``, a file, an
+        object with a ``write()`` method or a file descriptor.
         """
         self._generate_html_css(fp)
+
+
+class Renderer(object):
+    """
+    A reusable Markdown to HTML converter, for rendering many documents
+    with the same options.
+
+    The arguments are those of ``Markdown``, except for the input.  They
+    are validated once, when the renderer is created: unknown keyword
+    arguments raise a ``TypeError``, and boolean options which are false
+    are left out rather than enabling their flag.  The configuration
+    can't be changed afterwards, so a single renderer can be shared by
+    all the threads of a process:
+
+        >>> renderer = Renderer(autolink=True, rewrite_links_func=add_cdn)
+        >>> renderer.render('Visit http://example.com/')
+
+    Documents without link callbacks nor a cache are rendered without
+    a ``Markdown`` object, releasing the GIL for nearly all of the work.
+    ``render_many()`` uses a thread pool of ``workers`` threads
+    (defaults to the number of CPUs), started on first use and stopped
+    by ``close()``.
+    """
+    def __init__(
+        self, rewrite_links_func=None, link_attrs_func=None, cache=None,
+        link_rules=None, workers=None, **kwargs):
+
+        unknown = sorted(set(kwargs) - set(_KWARGS_TO_LIBMARKDOWN_FLAGS))
+        if unknown:
+            raise TypeError(
+                'unexpected keyword argument %r' % unknown[0])
+
+        if link_rules is not None:
+            if rewrite_links_func is not None or link_attrs_func is not None:
+                raise TypeError(
+                    'link_rules cannot be combined with link callbacks')
+            rewrite_links_func = link_rules.rewrite_links_func
+            link_attrs_func = link_rules.link_attrs_func
+
+        self._options = frozenset(
+            key for key, value in kwargs.iteritems() if value)
+        self._flags = _kwargs_to_flags(self._options)
+        self._rewrite_links_func = rewrite_links_func
+        self._link_attrs_func = link_attrs_func
+        self._cache = cache
+        self._workers = workers
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def flags(self):
+        """
+        The libmarkdown flags used for every document.
+        """
+        return self._flags
+
+    @property
+    def options(self):
+        """
+        The names of the boolean options enabled, as a frozenset.
+        """
+        return self._options
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def rewrite_links_func(self):
+        return self._rewrite_links_func
+
+    @property
+    def link_attrs_func(self):
+        return self._link_attrs_func
+
+    def _resources(self):
+        # Discount can't reset a document for reuse, so the documents
+        # themselves are freed as soon as they are rendered; what each
+        # thread keeps from one render to the next is the output
+        # pointer and the arena for callback results.
+        local = self._local
+        if not hasattr(local, 'arena'):
+            local.arena = _CallbackArena()
+            local.sb = ctypes.c_char_p()
+        return local
+
+    def _markdown(self, md):
+        md.flags = self._flags
+        md._arena = self._resources().arena
+        return md
+
+    def _needs_markdown(self):
+        return (self._cache is not None or
+                self._rewrite_links_func is not None or
+                self._link_attrs_func is not None)
+
+    def _render(self, text, flags):
+        if not self._needs_markdown():
+            return _render_html_content(text, flags, self._resources().sb)
+
+        with self._markdown(Markdown(
+            text,
+            rewrite_links_func=self._rewrite_links_func,
+            link_attrs_func=self._link_attrs_func,
+            cache=self._cache,
+        )) as md:
+            md.flags = flags
+            return md.get_html_content()
+
+    def render(self, text, ignore_header=False):
+        """
+        Convert a Markdown string to HTML.
+
+        With ``ignore_header``, a pandoc header at the start of
+        ``text`` is treated as regular text, as when ``text`` is a part
+        of a larger document other than its start.  The other options
+        are those of the renderer.
+        """
+        flags = self._flags
+        if ignore_header:
+            flags |= libmarkdown.MKD_NOHEADER
+        return self._render(text, flags)
+
+    def render_file(self, path):
+        """
+        Convert the Markdown file at ``path`` to HTML.  The file is
+        memory-mapped, as with ``Markdown.from_path()``.
+        """
+        with self._markdown(Markdown.from_path(
+            path,
+            rewrite_links_func=self._rewrite_links_func,
+            link_attrs_func=self._link_attrs_func,
+        )) as md:
+            return md.get_html_content()
+
+    def render_inline(self, text):
+        """
+        Convert a single line of Markdown to HTML, like
+        ``discount.render_inline()``.
+        """
+        return _render_inline(text, self._flags, self._resources().sb)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # Imported on first use, as in ``render_many()``.
+                import multiprocessing.pool
+
+                libmarkdown.mkd_initialize()
+                self._pool = multiprocessing.pool.ThreadPool(self._workers)
+            return self._pool
+
+    def render_many(self, texts, chunksize=16, ignore_header=False):
+        """
+        Convert an iterable of Markdown strings to HTML on the thread
+        pool, like ``discount.render_many()``, and return an iterator
+        over the results, in the same order.  ``ignore_header`` is the
+        same as for ``render()``.
+        """
+        render = self.render
+        if ignore_header:
+            render = functools.partial(render, ignore_header=True)
+        return self._get_pool().imap(render, texts, chunksize)
+
+    def close(self):
+        """
+        Stop the thread pool, if it was started.
+        """
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
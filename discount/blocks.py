@@ -0,0 +1,412 @@
+"""
+Splitting of Markdown documents into top-level blocks, and rendering
+of documents block by block.
+
+Discount compiles a document in two passes: reference definitions
+(``[id]: url "title"``) and html blocks are pulled out of the input
+first, then the rest is compiled into paragraphs, lists, headers and
+so on.  ``split_blocks()`` follows the same rules to find the
+boundaries between top-level blocks at which a document can be cut
+without changing how any part of it is parsed, and
+``find_references()`` collects the reference definitions, which apply
+to the whole document wherever they are.
+
+``IncrementalDocument`` uses both to render a document which is edited
+over and over, such as in a live preview, and only render the blocks
+that changed:
+
+    >>> doc = IncrementalDocument(text, autolink=True)
+    >>> for block in doc.update(edited_text):
+    ...     if block.changed:
+    ...         patch(block.id, block.html)
+
+``render_sharded()`` uses them to render a single huge document on
+several threads, in shards of consecutive blocks:
+
+    >>> html = render_sharded(changelog, workers=8)
+"""
+
+import difflib
+import itertools
+import re
+
+import discount
+import libmarkdown
+
+
+# Tags which start an html block when at the start of a line, as known
+# to Discount 1.6.6, and those added by ``discount.add_html5_tags()``.
+_BLOCK_TAGS = frozenset([
+    'ADDRESS', 'BDO', 'BLOCKQUOTE', 'CENTER', 'DD', 'DIR', 'DIV', 'DL',
+    'DT', 'FORM', 'H1', 'H2', 'H3', 'H4', 'H5', 'H6', 'LISTING', 'NOBR',
+    'OL', 'P', 'PLAINTEXT', 'PRE', 'SCRIPT', 'STYLE', 'TABLE', 'TD', 'TH',
+    'TR', 'UL', 'XMP',
+])
+_HTML5_TAGS = frozenset([
+    'ARTICLE', 'ASIDE', 'FOOTER', 'HEADER', 'HGROUP', 'NAV', 'SECTION',
+])
+
+_OPEN_TAG = re.compile(r'<(!--|[A-Za-z][A-Za-z0-9]*)')
+_REFERENCE = re.compile(r' {0,3}\[([^\[\]]*)\]:')
+_REFERENCE_TITLE = re.compile(r'[ \t]+["\'(]')
+_LIST_ITEM = re.compile(r' {0,3}(?:[*+-]|\d+\.|[A-Za-z]\.)[ \t]')
+_QUOTE = re.compile(r' {0,3}>')
+_LABEL = re.compile(r'\[([^\[\]]*)\]')
+
+
+def _block_tags():
+    # Tags registered so far change what counts as an html block.
+    tags = dict.fromkeys(_BLOCK_TAGS, False)
+    tags['!--'] = False
+    tags['HR'] = True
+    for registration in discount._tag_registrations:
+        if registration[0] == 'html5':
+            tags.update(dict.fromkeys(_HTML5_TAGS, False))
+        else:
+            tags[registration[1].upper()] = registration[2]
+    return tags
+
+
+def _normalize_label(label):
+    # Discount compares labels ignoring case, with any whitespace
+    # character matching any other.
+    return re.sub(r'\s', ' ', label.lower())
+
+
+def _is_blank(line):
+    return not line.strip()
+
+
+def _without_comments(line, in_comment):
+    # Return ``line`` with its html comments blanked out, and whether a
+    # comment is still open at its end.  ``in_comment`` is whether one
+    # is open at its start.
+    parts = []
+    pos = 0
+    while pos < len(line):
+        if in_comment:
+            end = line.find('-->', pos)
+            if end == -1:
+                break
+            in_comment = False
+            pos = end + 3
+        else:
+            begin = line.find('<!--', pos)
+            if begin == -1:
+                parts.append(line[pos:])
+                break
+            parts.append(line[pos:begin])
+            in_comment = True
+            pos = begin + 4
+    return ' '.join(parts), in_comment
+
+
+def _html_block_end(lines, start, tag, selfclose):
+    # Return the index of the last line of the html block starting at
+    # ``start``, or ``None`` if it is never closed.
+    if selfclose:
+        return start
+
+    if tag == '!--':
+        for i in xrange(start, len(lines)):
+            if '-->' in lines[i]:
+                return i
+        return None
+
+    pattern = re.compile(r'<(/?)%s(?=[\s>/])' % tag, re.I)
+    depth = 0
+    in_comment = False
+    for i in xrange(start, len(lines)):
+        # Like Discount, tags within comments aren't counted.
+        line, in_comment = _without_comments(lines[i], in_comment)
+        for match in pattern.finditer(line + '\n'):
+            if match.group(1):
+                depth -= 1
+                if depth <= 0:
+                    return i
+            else:
+                depth += 1
+    return None
+
+
+def _reference_end(lines, start, match):
+    # A reference definition whose title is on the next line, indented,
+    # spans two lines.
+    rest = lines[start][match.end():].split()
+    if rest and rest[-1].startswith('='):
+        rest.pop()
+    if (len(rest) <= 1 and start + 1 < len(lines) and
+        _REFERENCE_TITLE.match(lines[start + 1])):
+        return start + 2
+    return start + 1
+
+
+def _continues(block, line):
+    # Whether ``line``, found after blank lines, belongs to ``block``:
+    # indented lines may be code or list item continuations, and lists
+    # and blockquotes go on across blank lines.
+    if line[:1] in (' ', '\t'):
+        return True
+    if _LIST_ITEM.match(line):
+        return any(_LIST_ITEM.match(l) for l in block)
+    if _QUOTE.match(line):
+        return any(_QUOTE.match(l) for l in block)
+    return False
+
+
+def _scan(text, flags=0):
+    # Return the blocks of ``text``, its reference definitions, and
+    # whether its last block is an unclosed html block, in a single
+    # pass.
+    lines = text.split('\n')
+    html = not flags & libmarkdown.MKD_NOHTML
+    tags = _block_tags() if html else {}
+
+    blocks = []
+    references = []
+    block = []
+    unclosed = False
+
+    def flush():
+        while block and _is_blank(block[-1]):
+            block.pop()
+        if block:
+            blocks.append('\n'.join(block))
+        del block[:]
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+
+        match = _OPEN_TAG.match(line) if html else None
+        if match is not None and match.group(1).upper() in tags:
+            tag = match.group(1).upper()
+            end = _html_block_end(lines, i, tag, tags[tag])
+            flush()
+            if end is None:
+                # Unclosed html is compiled along with everything up to
+                # the end of the document, and no reference definition
+                # is looked for in it.
+                block.extend(lines[i:])
+                unclosed = True
+                break
+            block.extend(lines[i:end + 1])
+            flush()
+            i = end + 1
+            while i < len(lines) and _is_blank(lines[i]):
+                i += 1
+            continue
+
+        match = _REFERENCE.match(line)
+        if match is not None:
+            end = _reference_end(lines, i, match)
+            references.append((
+                _normalize_label(match.group(1)),
+                '\n'.join(lines[i:end]),
+            ))
+            # Blank lines after a definition go with it.
+            i = end
+            while i < len(lines) and _is_blank(lines[i]):
+                i += 1
+            continue
+
+        if _is_blank(line):
+            if block:
+                block.append(line)
+        elif block and _is_blank(block[-1]) and not _continues(block, line):
+            flush()
+            block.append(line)
+        else:
+            block.append(line)
+        i += 1
+
+    flush()
+    return blocks, references, unclosed
+
+
+def split_blocks(text, flags=0):
+    """
+    Split ``text`` into a list of top-level blocks, without the
+    reference definitions, which can each be rendered on their own.
+
+    A block is one or more paragraphs, lists, headers, code blocks or
+    blockquotes; lists, blockquotes and indented lines are never
+    separated from what they continue.  ``flags`` are the libmarkdown
+    flags the document is rendered with.
+    """
+    return _scan(text, flags)[0]
+
+
+def find_references(text, flags=0):
+    """
+    Return the reference definitions of ``text`` as a list of
+    ``(label, definition)`` tuples, in document order.  Labels are
+    normalized as Discount compares them.
+    """
+    return _scan(text, flags)[1]
+
+
+def _with_references(text, references, first, unclosed=False):
+    # Add the definitions of the labels ``text`` may refer to.  They go
+    # after the first block, which may start with a pandoc header, and
+    # before any other, which may end with unclosed html that would
+    # swallow them.  A first block which is unclosed html gets none, as
+    # it couldn't use them anyway.
+    if first and unclosed:
+        return text
+
+    used = set(_normalize_label(label) for label in _LABEL.findall(text))
+    definitions = [
+        definition for label, definition in references if label in used]
+    if not definitions:
+        return text
+    if first:
+        return '%s\n\n%s' % (text, '\n'.join(definitions))
+    return '%s\n\n%s' % ('\n'.join(definitions), text)
+
+
+class Block(object):
+    """
+    A top-level block of an ``IncrementalDocument``.
+
+    ``id`` stays the same from one update to the next as long as the
+    block is still there, even when its text is edited; ``changed`` is
+    true when its ``html`` differs from the previous update.
+    """
+    __slots__ = ('id', 'text', 'html', 'changed')
+
+    def __init__(self, id, text, html, changed):
+        self.id = id
+        self.text = text
+        self.html = html
+        self.changed = changed
+
+    def __repr__(self):
+        return '<Block id=%d changed=%r>' % (self.id, self.changed)
+
+
+class IncrementalDocument(object):
+    """
+    A Markdown document which is rendered again, block by block, each
+    time its text is updated.
+
+    Only the blocks whose text, or the definitions of the references
+    they use, changed since the previous update are rendered again.
+    The blocks are rendered with a ``discount.Renderer``, either given
+    as ``renderer`` or created from the keyword arguments.
+
+    ``update()`` returns the list of ``Block`` objects, after which
+    ``removed`` is the list of ids of the blocks which are gone, and
+    ``rendered`` the number of blocks which had to be rendered.
+    """
+    def __init__(self, text='', renderer=None, **kwargs):
+        if renderer is None:
+            renderer = discount.Renderer(**kwargs)
+        self.renderer = renderer
+        self.blocks = []
+        self.removed = []
+        self.rendered = 0
+        self._ids = itertools.count(1)
+        self._html = {}
+        self.update(text)
+
+    def _render(self, source, first):
+        # Only the first block may have a pandoc header.
+        return self.renderer.render(source, ignore_header=not first)
+
+    def update(self, text):
+        """
+        Replace the text of the document, and return its blocks.
+        """
+        texts, references, unclosed = _scan(text, self.renderer.flags)
+
+        # Blocks keep their id when they are unchanged, or edited in
+        # place.
+        old = self.blocks
+        ids = [None] * len(texts)
+        matcher = difflib.SequenceMatcher(
+            None, [block.text for block in old], texts, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag in ('equal', 'replace'):
+                for k in xrange(min(i2 - i1, j2 - j1)):
+                    ids[j1 + k] = old[i1 + k].id
+
+        previous = dict((block.id, block.html) for block in old)
+        cache, self._html = self._html, {}
+        self.rendered = 0
+
+        blocks = []
+        for index, (block_id, block_text) in enumerate(zip(ids, texts)):
+            first = index == 0
+            key = (first, _with_references(
+                block_text, references, first,
+                unclosed and index == len(texts) - 1))
+            html = cache.get(key)
+            if html is None:
+                html = self._render(key[1], first)
+                self.rendered += 1
+            self._html[key] = html
+
+            if block_id is None:
+                block_id = next(self._ids)
+            blocks.append(Block(
+                block_id, block_text, html, previous.get(block_id) != html))
+
+        kept = set(block.id for block in blocks)
+        self.removed = [block.id for block in old if block.id not in kept]
+        self.blocks = blocks
+        return blocks
+
+    @property
+    def html(self):
+        """
+        The HTML of the whole document.
+        """
+        return '\n\n'.join(block.html for block in self.blocks if block.html)
+
+
+def _shards(blocks, size):
+    shard = []
+    shard_size = 0
+    for block in blocks:
+        shard.append(block)
+        shard_size += len(block)
+        if shard_size >= size:
+            yield shard
+            shard = []
+            shard_size = 0
+    if shard:
+        yield shard
+
+
+def render_sharded(text, renderer=None, shard_size=1024 * 1024, **kwargs):
+    """
+    Convert a large Markdown string to HTML on several threads, and
+    return the same HTML as rendering it in one go.
+
+    The document is cut between top-level blocks into shards of about
+    ``shard_size`` bytes, each of which gets the reference definitions
+    it refers to.  The shards are rendered with the thread pool of
+    ``renderer``, a ``discount.Renderer``, or of one created from the
+    keyword arguments for this call, then joined back together.
+    """
+    if renderer is None:
+        with discount.Renderer(**kwargs) as renderer:
+            return render_sharded(text, renderer, shard_size)
+
+    blocks, references, unclosed = _scan(text, renderer.flags)
+    shards = list(_shards(blocks, shard_size))
+    sources = [
+        _with_references(
+            '\n\n'.join(shard), references, index == 0,
+            unclosed and index == len(shards) - 1)
+        for index, shard in enumerate(shards)
+    ]
+    if len(sources) <= 1:
+        return renderer.render(text)
+
+    # Only the first shard may have a pandoc header; it's rendered on
+    # this thread while the pool works on the others.
+    rest = renderer.render_many(sources[1:], chunksize=1, ignore_header=True)
+    results = itertools.chain([renderer.render(sources[0])], rest)
+    return '\n\n'.join(html for html in results if html)
@@ -0,0 +1,427 @@
+"""
+Caches for rendered HTML.
+
+A cache is passed to ``Markdown`` with the ``cache`` keyword argument,
+and is then consulted by ``get_html_content()``, ``get_html_toc()``
+and ``get_html_css()`` before rendering anything:
+
+    >>> cache = RenderCache(max_bytes=32 * 1024 * 1024)
+    >>> Markdown(text, cache=cache).get_html_content()
+
+Entries are keyed on a hash of the input, the flags, the link
+callbacks and the tags registered with ``define_tag()`` and
+``add_html5_tags()``, so a cache can safely be shared between
+``Markdown`` objects with different options.  Only string input is
+cached; file input is always rendered.
+
+``RenderCache`` keeps entries in memory, for a single process.
+``DiskCache`` keeps them in a sqlite database in a local directory,
+which can be shared by many processes and survives restarts.
+
+``MemoizedLinkCallback`` is a different kind of cache, for the results
+of link callbacks rather than whole documents.
+"""
+
+import collections
+import ctypes
+import hashlib
+import os
+import sys
+import threading
+import time
+
+
+class RenderCache(object):
+    """
+    In-memory LRU cache of rendered HTML.
+
+    The cache holds at most ``max_bytes`` bytes of HTML; the least
+    recently used entries are evicted to make room for new ones.
+    Values larger than ``max_bytes`` are not cached at all.
+
+    The ``hits``, ``misses`` and ``evictions`` counters are kept up to
+    date, and are returned along with the current size by ``stats()``.
+    The cache can be shared between threads.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the value cached for ``key``, or ``None``.
+        """
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Cache ``value`` for ``key``, evicting old entries if needed.
+        """
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+
+            while self._entries and self._size + size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+            self._entries[key] = value
+            self._size += size
+
+    def clear(self):
+        """
+        Remove all entries.  The counters are left untouched.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Return the cache counters and current size as a dict.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+            }
+
+
+_MISSING = object()
+
+
+class MemoizedLinkCallback(object):
+    """
+    Wraps a ``rewrite_links_func`` or ``link_attrs_func`` callback,
+    remembering its results for the ``max_entries`` most recently used
+    urls.
+
+    The results are kept as ctypes buffers, which ``Markdown`` hands
+    to Discount directly; a url seen before costs neither a call to
+    the callback nor a new buffer.  The same wrapper can, and should,
+    be shared between ``Markdown`` objects and threads:
+
+        >>> add_basepath = MemoizedLinkCallback(add_basepath)
+        >>> Markdown(text, rewrite_links_func=add_basepath)
+
+    The callback must always return the same result for the same url.
+    The ``hits`` and ``misses`` counters, and the hit rate, are
+    returned by ``stats()``.
+    """
+    def __init__(self, func, max_entries=4096):
+        self.__wrapped__ = func
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        buf = self.buffer_for(url)
+        return buf.value if buf is not None else None
+
+    def buffer_for(self, url):
+        """
+        Return the callback result for ``url`` as a ctypes buffer, or
+        ``None`` if the callback returned ``None``.
+        """
+        with self._lock:
+            buf = self._entries.pop(url, _MISSING)
+            if buf is not _MISSING:
+                self._entries[url] = buf
+                self.hits += 1
+                return buf
+            self.misses += 1
+
+        ret = self.__wrapped__(url)
+        buf = ctypes.create_string_buffer(ret) if ret is not None else None
+
+        with self._lock:
+            self._entries[url] = buf
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return buf
+
+    def clear(self):
+        """
+        Forget all results.  The counters are left untouched.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return the counters, hit rate and number of entries as a dict.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+            }
+
+
+def _callback_identity(func):
+    # Functions are only identified by name across processes if the
+    # name actually leads back to them; lambdas and closures can't be
+    # told apart that way.  Callbacks built from a description, like
+    # ``LinkRules``, carry their own identity.
+    identity = getattr(func, 'cache_identity', None)
+    if identity is not None:
+        return identity
+    func = getattr(func, '__wrapped__', func)
+    module = sys.modules.get(getattr(func, '__module__', None))
+    name = getattr(func, '__name__', None)
+    if module is None or getattr(module, name, None) is not func:
+        return None
+    return '%s.%s' % (module.__name__, name)
+
+
+def _stable_key(key):
+    # Return a digest of ``key`` that is the same in every process, or
+    # ``None`` if it refers to callbacks without a stable identity.
+    parts = []
+    for part in key:
+        if callable(part):
+            part = _callback_identity(part)
+            if part is None:
+                return None
+        parts.append(part)
+    return hashlib.sha1(repr(tuple(parts))).hexdigest()
+
+
+# Access times are kept in memory and written in batches of this many
+# entries, rather than on every hit.
+_ATIME_BATCH = 64
+
+
+class DiskCache(object):
+    """
+    Persistent cache of rendered HTML, stored in a sqlite database in
+    the directory ``path``.
+
+    Any number of processes can use the same directory at once; a
+    process started after a deploy finds the entries stored by its
+    predecessors.  The least recently used entries are evicted once
+    the stored HTML grows beyond ``max_bytes``.
+
+    Link callbacks are identified by their module and name, so only
+    functions defined at the top level of a module can be part of a
+    key; documents using any other callback are never cached.
+
+    The ``hits``, ``misses`` and ``evictions`` counters are kept per
+    process.  Hits never wait for another process writing to the
+    database: access times are written in batches, and skipped if the
+    database is busy, which only makes some entries a little more
+    likely to be evicted.
+    """
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, timeout=30.0):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+
+        db = self._connect()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            ' key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)'
+        )
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)'
+        )
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS totals (size INTEGER)'
+        )
+        db.execute('BEGIN IMMEDIATE')
+        if db.execute('SELECT COUNT(*) FROM totals').fetchone()[0] == 0:
+            db.execute('INSERT INTO totals VALUES (0)')
+        db.execute('COMMIT')
+
+    def _connect(self):
+        # sqlite3 is only imported once a ``DiskCache`` is used, rather
+        # than with this module.
+        import sqlite3
+
+        # sqlite connections can't be shared between threads, nor
+        # survive a fork, so there is one per thread and process.
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(
+                os.path.join(self.path, 'render-cache.sqlite'),
+                timeout=self.timeout, isolation_level=None,
+            )
+            db.text_factory = str
+            # The cache can lose its last writes in a power failure
+            # without being corrupted, so commits aren't synced.
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+            self._local.atimes = {}
+        return db
+
+    def _write_atimes(self, db):
+        # Called within a write transaction.
+        atimes = self._local.atimes
+        if atimes:
+            db.executemany(
+                'UPDATE entries SET atime = ? WHERE key = ?',
+                [(atime, key) for key, atime in atimes.iteritems()]
+            )
+            atimes.clear()
+
+    def _flush_atimes(self, db):
+        # Only write if the database isn't busy, rather than waiting
+        # for up to ``timeout`` seconds; the access times are kept for
+        # the next attempt otherwise.
+        import sqlite3
+
+        db.execute('PRAGMA busy_timeout=0')
+        try:
+            db.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            return
+        finally:
+            db.execute('PRAGMA busy_timeout=%d' % (self.timeout * 1000))
+
+        try:
+            self._write_atimes(db)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def get(self, key):
+        """
+        Return the value cached for ``key``, or ``None``.
+        """
+        key = _stable_key(key)
+        if key is None:
+            self.misses += 1
+            return None
+
+        db = self._connect()
+        row = db.execute(
+            'SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        atimes = self._local.atimes
+        atimes[key] = time.time()
+        if len(atimes) >= _ATIME_BATCH:
+            self._flush_atimes(db)
+
+        self.hits += 1
+        return str(row[0])
+
+    def set(self, key, value):
+        """
+        Cache ``value`` for ``key``, evicting old entries if needed.
+        """
+        key = _stable_key(key)
+        size = len(value)
+        if key is None or size > self.max_bytes:
+            return
+
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # Entries read since the last batch must not be evicted.
+            self._write_atimes(db)
+
+            row = db.execute(
+                'SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            old_size = row[0] if row is not None else 0
+
+            db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (key, buffer(value), size, time.time())
+            )
+            db.execute('UPDATE totals SET size = size + ?', (size - old_size,))
+
+            total = db.execute('SELECT size FROM totals').fetchone()[0]
+            while total > self.max_bytes:
+                rows = db.execute(
+                    'SELECT key, size FROM entries WHERE key != ?'
+                    ' ORDER BY atime LIMIT 16', (key,)
+                ).fetchall()
+                if not rows:
+                    break
+                for evicted_key, evicted_size in rows:
+                    db.execute(
+                        'DELETE FROM entries WHERE key = ?', (evicted_key,))
+                    total -= evicted_size
+                    self.evictions += 1
+                    if total <= self.max_bytes:
+                        break
+            db.execute('UPDATE totals SET size = ?', (total,))
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def clear(self):
+        """
+        Remove all entries.  The counters are left untouched.
+        """
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('DELETE FROM entries')
+        db.execute('UPDATE totals SET size = 0')
+        db.execute('COMMIT')
+
+    def stats(self):
+        """
+        Return the cache counters and current size as a dict.
+        """
+        db = self._connect()
+        entries, size = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries'
+        ).fetchone()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+        }
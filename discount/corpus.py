@@ -0,0 +1,184 @@
+"""
+Rendering of large collections of Markdown documents on a pool of
+worker processes.
+
+Unlike ``discount.render_many()``, which uses threads, this keeps
+every CPU busy even when ``rewrite_links_func`` or ``link_attrs_func``
+callbacks are used, since those need the GIL for every link.
+
+    >>> renderer = CorpusRenderer(processes=4, autolink=True)
+    >>> for html in renderer.render_files(paths):
+    ...     save(html)
+    >>> renderer.close()
+
+The callbacks have to be picklable, i.e. functions defined at the top
+level of a module.
+"""
+
+import multiprocessing
+import os
+import time
+
+import discount
+import libmarkdown
+
+
+# Per-process state of a worker, set up once by ``_initialize_worker``.
+_worker = {}
+
+
+def _initialize_worker(registrations, rewrite_links_func, link_attrs_func,
+                       kwargs):
+    libmarkdown.mkd_initialize()
+    discount._replay_tag_registrations(registrations)
+
+    _worker['rewrite_links_func'] = rewrite_links_func
+    _worker['link_attrs_func'] = link_attrs_func
+    _worker['kwargs'] = kwargs
+    _worker['flags'] = discount._kwargs_to_flags(kwargs)
+
+
+def _render(text):
+    if (_worker['rewrite_links_func'] is None and
+        _worker['link_attrs_func'] is None):
+        return discount._render_html_content(text, _worker['flags'])
+
+    md = discount.Markdown(
+        text,
+        rewrite_links_func=_worker['rewrite_links_func'],
+        link_attrs_func=_worker['link_attrs_func'],
+        **_worker['kwargs']
+    )
+    return md.get_html_content()
+
+
+def _read(path):
+    fp = open(path, 'rb')
+    try:
+        return fp.read()
+    finally:
+        fp.close()
+
+
+def _render_chunk(task):
+    read, chunk = task
+    start = time.time()
+    input_bytes = 0
+    results = []
+    for item in chunk:
+        text = _read(item) if read else item
+        input_bytes += len(text)
+        results.append(_render(text))
+    return os.getpid(), time.time() - start, input_bytes, results
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class WorkerStats(object):
+    """
+    Running totals for a single worker process.
+    """
+    __slots__ = ('pid', 'documents', 'bytes', 'seconds')
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.documents = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Documents rendered per second of worker time.
+        """
+        if not self.seconds:
+            return 0.0
+        return self.documents / self.seconds
+
+    def __repr__(self):
+        return '<WorkerStats pid=%d documents=%d bytes=%d seconds=%.3f>' % (
+            self.pid, self.documents, self.bytes, self.seconds)
+
+
+class CorpusRenderer(object):
+    """
+    Markdown to HTML conversion of many documents on a pool of
+    ``processes`` worker processes (defaults to the number of CPUs).
+
+    The workers are started once, when the renderer is created.  Each
+    of them initializes Discount and replays the tags registered with
+    ``discount.define_tag()`` and ``discount.add_html5_tags()`` so far,
+    then renders documents handed out in chunks of ``chunksize``.
+
+    ``rewrite_links_func``, ``link_attrs_func`` and the boolean keyword
+    arguments are the same as for ``discount.Markdown``.
+
+    Per-worker totals are available from ``worker_stats``, a dict of
+    ``WorkerStats`` keyed by process id.
+    """
+    def __init__(
+        self, processes=None, chunksize=64,
+        rewrite_links_func=None, link_attrs_func=None,
+        **kwargs):
+
+        self.chunksize = chunksize
+        self.worker_stats = {}
+        self._pool = multiprocessing.Pool(
+            processes,
+            initializer=_initialize_worker,
+            initargs=(
+                list(discount._tag_registrations),
+                rewrite_links_func, link_attrs_func, kwargs,
+            )
+        )
+
+    def _imap(self, read, items):
+        chunks = ((read, chunk) for chunk in _chunks(items, self.chunksize))
+        for pid, seconds, input_bytes, results in self._pool.imap(
+            _render_chunk, chunks):
+            stats = self.worker_stats.get(pid)
+            if stats is None:
+                stats = self.worker_stats[pid] = WorkerStats(pid)
+            stats.documents += len(results)
+            stats.bytes += input_bytes
+            stats.seconds += seconds
+
+            for html in results:
+                yield html
+
+    def render(self, texts):
+        """
+        Render an iterable of Markdown strings, yielding the HTML in
+        the same order.
+        """
+        return self._imap(False, texts)
+
+    def render_files(self, paths):
+        """
+        Render an iterable of file paths, yielding the HTML in the same
+        order.  Files are read by the workers, so their contents never
+        pass through this process.
+        """
+        return self._imap(True, paths)
+
+    def close(self):
+        """
+        Stop the worker processes, once pending work is done.
+        """
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
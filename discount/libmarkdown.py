@@ -24,6 +24,9 @@ It is important to initialize `c_char_p` with an empty string.
 
 import ctypes
 import os
+import sys
+import threading
+import types
 
 
 MKD_NOLINKS = 0x0001
@@ -41,15 +44,93 @@ MKD_AUTOLINK =  0x4000
 MKD_SAFELINK = 0x8000
 
 
-_so = ctypes.CDLL(
-    os.path.join(
-        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
-        '_discount.so'
-    )
-)
-
-
-markdown_version = (ctypes.c_char * 64).in_dll(_so, 'markdown_version').value
+# The shared libraries are only loaded, and the prototypes of the
+# functions below only set up, the first time one of the functions is
+# called (or ``load()``, or ``markdown_version`` is used), so that
+# importing this module is cheap.
+_so = None
+_libc = None
+_functions = []
+_load_lock = threading.Lock()
+
+
+class _Function(object):
+    """
+    A function of the Discount shared library (or of libc), which is
+    bound when it is first called.  ``argtypes`` and ``restype`` are
+    set the same way as on ctypes functions.
+    """
+    def __init__(self, name, library='discount'):
+        self.__name__ = name
+        self.library = library
+        self.argtypes = None
+        self.restype = ctypes.c_int
+        self._bound = None
+        _functions.append(self)
+
+    def __repr__(self):
+        return '<unbound libmarkdown function %s>' % self.__name__
+
+    def __call__(self, *args):
+        bound = self._bound
+        if bound is None:
+            load()
+            bound = self._bound
+        return bound(*args)
+
+
+def load():
+    """
+    Load the Discount shared library and set up the function
+    prototypes, if that hasn't happened yet.  This is thread-safe, and
+    done automatically when any of the functions is first called.
+    """
+    if _so is not None:
+        return
+
+    with _load_lock:
+        if _so is not None:
+            return
+
+        # ``ctypes.util`` pulls in subprocess and tempfile, just to
+        # find libc.
+        import ctypes.util
+
+        so = ctypes.CDLL(
+            os.path.join(
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                '_discount.so'
+            )
+        )
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+
+        namespace = {}
+        for function in _functions:
+            library = so if function.library == 'discount' else libc
+            bound = getattr(library, function.__name__)
+            bound.argtypes = function.argtypes
+            bound.restype = function.restype
+            function._bound = bound
+            namespace[function.__name__] = bound
+
+        namespace['markdown_version'] = (
+            ctypes.c_char * 64).in_dll(so, 'markdown_version').value
+        namespace['_libc'] = libc
+
+        # From now on, the module attributes are the ctypes functions
+        # themselves, without going through ``_Function``.  ``_so`` is
+        # set last, as it tells other threads that loading is done.
+        for module_dict in sys.modules[__name__].__dict__, globals():
+            module_dict.update(namespace)
+        sys.modules[__name__].__dict__['_so'] = so
+        globals()['_so'] = so
+
+
+# Some functions, like ``mkd_line``, hand over memory that has to be
+# released by the caller.
+free = _Function('free', library='c')
+free.argtypes = (ctypes.c_void_p,)
+free.restype = None
 
 
 class FILE(ctypes.Structure):
@@ -60,6 +141,58 @@ ctypes.pythonapi.PyFile_AsFile.argtypes = (ctypes.py_object,)
 
 ctypes.pythonapi.PyFile_AsFile.restype = ctypes.POINTER(FILE)
 
+fdopen = _Function('fdopen', library='c')
+fdopen.argtypes = (ctypes.c_int, ctypes.c_char_p)
+fdopen.restype = ctypes.POINTER(FILE)
+
+fclose = _Function('fclose', library='c')
+fclose.argtypes = (ctypes.POINTER(FILE),)
+
+
+# The buffer protocol, used to pass the memory of objects like
+# ``bytearray`` or ``mmap`` to and from Discount without copying it.
+PyBUF_SIMPLE = 0
+PyBUF_WRITABLE = 0x0001
+
+
+class Py_buffer(ctypes.Structure):
+    _fields_ = [
+        ('buf', ctypes.c_void_p),
+        ('obj', ctypes.c_void_p),
+        ('len', ctypes.c_ssize_t),
+        ('itemsize', ctypes.c_ssize_t),
+        ('readonly', ctypes.c_int),
+        ('ndim', ctypes.c_int),
+        ('format', ctypes.c_char_p),
+        ('shape', ctypes.POINTER(ctypes.c_ssize_t)),
+        ('strides', ctypes.POINTER(ctypes.c_ssize_t)),
+        ('suboffsets', ctypes.POINTER(ctypes.c_ssize_t)),
+        ('smalltable', ctypes.c_ssize_t * 2),
+        ('internal', ctypes.c_void_p),
+    ]
+
+
+ctypes.pythonapi.PyObject_GetBuffer.argtypes = (
+    ctypes.py_object,
+    ctypes.POINTER(Py_buffer),
+    ctypes.c_int,
+)
+
+ctypes.pythonapi.PyBuffer_Release.argtypes = (ctypes.POINTER(Py_buffer),)
+ctypes.pythonapi.PyBuffer_Release.restype = None
+
+ctypes.pythonapi.PyObject_AsReadBuffer.argtypes = (
+    ctypes.py_object,
+    ctypes.POINTER(ctypes.c_void_p),
+    ctypes.POINTER(ctypes.c_ssize_t),
+)
+
+ctypes.pythonapi.PyObject_AsWriteBuffer.argtypes = (
+    ctypes.py_object,
+    ctypes.POINTER(ctypes.c_void_p),
+    ctypes.POINTER(ctypes.c_ssize_t),
+)
+
 
 class Cstring(ctypes.Structure):
     _fields_ = [
@@ -99,6 +232,13 @@ Paragraph._fields_ = [
     ('hnumber', ctypes.c_int),
 ]
 
+# Values of ``Paragraph.typ``
+(WHITESPACE, CODE, QUOTE, MARKUP, HTML, STYLE, DL, UL, OL, AL, LISTITEM,
+ HDR, HR, TABLE, SOURCE) = range(15)
+
+# Values of ``Paragraph.align``
+IMPLICIT, PARA, CENTER = range(3)
+
 
 class Block(ctypes.Structure):
     _fields_ = [
@@ -177,16 +317,16 @@ e_free_callback = ctypes.CFUNCTYPE(
 )
 
 
-mkd_initialize = _so.mkd_initialize
+mkd_initialize = _Function('mkd_initialize')
 
-mkd_in = _so.mkd_in
+mkd_in = _Function('mkd_in')
 mkd_in.argtypes = (
     ctypes.POINTER(FILE),
     ctypes.c_int,
 )
 mkd_in.restype = ctypes.POINTER(Document)
 
-mkd_string = _so.mkd_string
+mkd_string = _Function('mkd_string')
 mkd_string.argtypes = (
     ctypes.c_char_p,
     ctypes.c_int,
@@ -194,14 +334,14 @@ mkd_string.argtypes = (
 )
 mkd_string.restype = ctypes.POINTER(Document)
 
-markdown = _so.markdown
+markdown = _Function('markdown')
 markdown.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(FILE),
     ctypes.c_int,
 )
 
-mkd_line = _so.mkd_line
+mkd_line = _Function('mkd_line')
 mkd_line.argtypes = (
     ctypes.c_char_p,
     ctypes.c_int,
@@ -209,7 +349,7 @@ mkd_line.argtypes = (
     ctypes.c_int,
 )
 
-mkd_generateline = _so.mkd_generateline
+mkd_generateline = _Function('mkd_generateline')
 mkd_generateline.argtypes = (
     ctypes.c_char_p,
     ctypes.c_int,
@@ -217,49 +357,49 @@ mkd_generateline.argtypes = (
     ctypes.c_int,
 )
 
-mkd_compile = _so.mkd_compile
+mkd_compile = _Function('mkd_compile')
 mkd_compile.argtypes = (
     ctypes.POINTER(Document),
     ctypes.c_int,
 )
 
-mkd_generatehtml = _so.mkd_generatehtml
+mkd_generatehtml = _Function('mkd_generatehtml')
 mkd_generatehtml.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(FILE),
 )
 
-mkd_document = _so.mkd_document
+mkd_document = _Function('mkd_document')
 mkd_document.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(ctypes.c_char_p),
 )
 
-mkd_css = _so.mkd_css
+mkd_css = _Function('mkd_css')
 mkd_css.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(ctypes.c_char_p),
 )
 
-mkd_generatecss = _so.mkd_generatecss
+mkd_generatecss = _Function('mkd_generatecss')
 mkd_generatecss.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(FILE),
 )
 
-mkd_toc = _so.mkd_toc
+mkd_toc = _Function('mkd_toc')
 mkd_toc.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(ctypes.c_char_p),
 )
 
-mkd_generatetoc = _so.mkd_generatetoc
+mkd_generatetoc = _Function('mkd_generatetoc')
 mkd_generatetoc.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(FILE),
 )
 
-mkd_dump = _so.mkd_dump
+mkd_dump = _Function('mkd_dump')
 mkd_dump.argtypes = (
     ctypes.POINTER(Document),
     ctypes.POINTER(FILE),
@@ -267,39 +407,59 @@ mkd_dump.argtypes = (
     ctypes.c_char_p,
 )
 
-mkd_cleanup = _so.mkd_cleanup
+mkd_cleanup = _Function('mkd_cleanup')
 mkd_cleanup.argtypes = (ctypes.POINTER(Document),)
 mkd_cleanup.restype = ctypes.c_void_p
 
-mkd_doc_title = _so.mkd_doc_title
+mkd_doc_title = _Function('mkd_doc_title')
 mkd_doc_title.argtypes = (ctypes.POINTER(Document),)
 mkd_doc_title.restype = ctypes.c_char_p
 
-mkd_doc_author = _so.mkd_doc_author
+mkd_doc_author = _Function('mkd_doc_author')
 mkd_doc_author.argtypes = (ctypes.POINTER(Document),)
 mkd_doc_author.restype = ctypes.c_char_p
 
-mkd_doc_date = _so.mkd_doc_date
+mkd_doc_date = _Function('mkd_doc_date')
 mkd_doc_date.argtypes = (ctypes.POINTER(Document),)
 mkd_doc_date.restype = ctypes.c_char_p
 
-mkd_e_url = _so.mkd_e_url
+mkd_e_url = _Function('mkd_e_url')
 mkd_e_url.argtypes = (ctypes.POINTER(Document), e_url_callback)
 mkd_e_url.restype = ctypes.c_void_p
 
-mkd_e_flags = _so.mkd_e_flags
+mkd_e_flags = _Function('mkd_e_flags')
 mkd_e_flags.argtypes = (ctypes.POINTER(Document), e_flags_callback)
 mkd_e_flags.restype = ctypes.c_void_p
 
-mkd_e_free = _so.mkd_e_free
+mkd_e_free = _Function('mkd_e_free')
 mkd_e_free.argtypes = (ctypes.POINTER(Document), e_free_callback)
 mkd_e_free.restype = ctypes.c_void_p
 
-mkd_e_data = _so.mkd_e_data
+mkd_e_data = _Function('mkd_e_data')
 mkd_e_data.argtypes = (ctypes.POINTER(Document), ctypes.c_void_p)
 mkd_e_data.restype = ctypes.c_void_p
 
-mkd_with_html5_tags = _so.mkd_with_html5_tags
+mkd_with_html5_tags = _Function('mkd_with_html5_tags')
 
-mkd_define_tag = _so.mkd_define_tag
+mkd_define_tag = _Function('mkd_define_tag')
 mkd_define_tag.argtypes = (ctypes.c_char_p, ctypes.c_int)
+
+
+class _LazyModule(types.ModuleType):
+    # Stands in for this module in ``sys.modules``, so that reading
+    # ``markdown_version`` can load the library on demand.
+    def __init__(self, module):
+        types.ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # Python 2 clears the globals of a module once it is garbage
+        # collected, and the functions above still use them.
+        self._module = module
+
+    def __getattr__(self, name):
+        if name == 'markdown_version':
+            load()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+
+sys.modules[__name__] = _LazyModule(sys.modules[__name__])
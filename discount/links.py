@@ -0,0 +1,159 @@
+"""
+Declarative link rewriting.
+
+``LinkRules`` covers the common uses of the ``rewrite_links_func`` and
+``link_attrs_func`` callbacks, without writing them by hand: prefix
+substitution, forcing https, neutralizing links to denied hosts and
+adding attributes to links to external hosts.
+
+    >>> rules = LinkRules(
+    ...     prefixes={'/media/': 'https://cdn.example.com/media/'},
+    ...     force_https=True,
+    ...     allow_hosts=['example.com'],
+    ...     external_attrs='rel="nofollow" target="_blank"',
+    ... )
+    >>> Markdown(text, link_rules=rules).get_html_content()
+
+The rules are compiled once, when the object is created, and their
+results are memoized per url in ``MemoizedLinkCallback`` wrappers, so
+a ``LinkRules`` object should be created once and shared between
+documents.
+"""
+
+import cgi
+import urlparse
+
+from cache import MemoizedLinkCallback
+
+
+def _host_matches(host, hosts):
+    # A host matches itself and all of its subdomains.
+    while host:
+        if host in hosts:
+            return True
+        host = host.partition('.')[2]
+    return False
+
+
+class LinkRules(object):
+    """
+    A set of rules applied to every link of a document.
+
+    ``prefixes``
+        A mapping of url prefixes to their replacements, i.e.
+        ``{'/media/': 'https://cdn.example.com/media/'}``.  The
+        longest matching prefix is replaced.
+
+    ``force_https``
+        Rewrite ``http://`` urls to ``https://``.
+
+    ``allow_hosts``
+        Hosts, and their subdomains, which are not external.  If not
+        given, every absolute url is external; relative urls never
+        are.
+
+    ``deny_hosts``
+        Hosts, and their subdomains, whose links are replaced with
+        ``denied_url``.
+
+    ``attrs``
+        Attributes added to every link.
+
+    ``external_attrs``
+        Attributes added to links to external hosts, i.e.
+        ``'rel="nofollow" target="_blank"'``.
+
+    Attribute templates can refer to ``{url}`` and ``{host}``, the
+    rewritten url and its host, which are escaped for use in an
+    attribute value.  Prefixes are replaced before anything else, so
+    the other rules apply to the replacement.
+    """
+    def __init__(
+        self, prefixes=None, force_https=False,
+        allow_hosts=None, deny_hosts=None, denied_url='#',
+        attrs=None, external_attrs=None, max_entries=4096):
+
+        self.prefixes = sorted(
+            dict(prefixes or {}).items(), key=lambda item: -len(item[0]))
+        self.force_https = force_https
+        self.allow_hosts = (
+            frozenset(host.lower() for host in allow_hosts)
+            if allow_hosts is not None else None)
+        self.deny_hosts = frozenset(host.lower() for host in deny_hosts or ())
+        self.denied_url = denied_url
+        self.attrs = attrs
+        self.external_attrs = external_attrs
+
+        identity = 'discount.links.LinkRules%r' % (self._key(),)
+
+        self.rewrite_links_func = None
+        if self.prefixes or self.force_https or self.deny_hosts:
+            self.rewrite_links_func = MemoizedLinkCallback(
+                self.rewrite, max_entries)
+            self.rewrite_links_func.cache_identity = identity
+
+        self.link_attrs_func = None
+        if attrs or external_attrs:
+            self.link_attrs_func = MemoizedLinkCallback(
+                self.attributes, max_entries)
+            self.link_attrs_func.cache_identity = identity
+
+    def _key(self):
+        return (
+            tuple(self.prefixes), self.force_https,
+            tuple(sorted(self.allow_hosts))
+            if self.allow_hosts is not None else None,
+            tuple(sorted(self.deny_hosts)), self.denied_url,
+            self.attrs, self.external_attrs,
+        )
+
+    def _apply(self, url):
+        # Return the rewritten url, its host, and whether it's denied.
+        for prefix, replacement in self.prefixes:
+            if url.startswith(prefix):
+                url = replacement + url[len(prefix):]
+                break
+
+        host = urlparse.urlsplit(url).hostname
+        if host is not None and _host_matches(host, self.deny_hosts):
+            return self.denied_url, host, True
+
+        if self.force_https and url[:7].lower() == 'http://':
+            url = 'https://' + url[7:]
+        return url, host, False
+
+    def rewrite(self, url):
+        """
+        Return ``url`` rewritten by the rules, or ``None`` if the rules
+        leave it unchanged.
+        """
+        rewritten = self._apply(url)[0]
+        return rewritten if rewritten != url else None
+
+    def is_external(self, url):
+        """
+        Return whether ``url``, once rewritten, links to an external
+        host.
+        """
+        host = self._apply(url)[1]
+        if host is None:
+            return False
+        return (self.allow_hosts is None or
+                not _host_matches(host, self.allow_hosts))
+
+    def attributes(self, url):
+        """
+        Return the attributes to add to a link to ``url``, or ``None``.
+        """
+        rewritten, host, denied = self._apply(url)
+        fields = {
+            'url': cgi.escape(rewritten, quote=True),
+            'host': cgi.escape(host or '', quote=True),
+        }
+
+        attrs = []
+        if self.attrs:
+            attrs.append(self.attrs.format(**fields))
+        if self.external_attrs and not denied and self.is_external(url):
+            attrs.append(self.external_attrs.format(**fields))
+        return ' '.join(attrs) or None
@@ -0,0 +1,655 @@
+"""
+The structure of compiled Markdown documents, read straight from
+Discount's ``Paragraph`` tree without generating any HTML.
+
+    >>> for node in Markdown(text).get_tree():
+    ...     print node.type_name, node.lines
+
+Each ``Paragraph`` becomes a ``Node``.  The ``SOURCE`` paragraphs,
+which Discount uses internally to hold the Markdown found between html
+blocks, are left out and replaced by their children.
+
+For analysis of large numbers of documents, ``FlatTree`` holds the same
+structure in a handful of ``array.array`` columns instead:
+
+    >>> flat = Markdown(text).get_flat_tree()
+    >>> flat.max_depth(), flat.heading_counts()
+
+``build_outline()`` only reads the top-level headers,
+``build_links()`` lists the urls of the document and
+``iter_plain_text()`` extracts its visible text.
+"""
+
+import array
+import collections
+import re
+import string
+
+import libmarkdown
+
+
+TYPE_NAMES = (
+    'whitespace', 'code', 'quote', 'markup', 'html', 'style', 'dl', 'ul',
+    'ol', 'al', 'listitem', 'hdr', 'hr', 'table', 'source',
+)
+
+ALIGN_NAMES = ('implicit', 'para', 'center')
+
+
+class Node(object):
+    """
+    A block of a compiled document.
+
+    ``type``
+        The block type, one of the ``Paragraph.typ`` values in
+        ``libmarkdown`` such as ``libmarkdown.HDR``; ``type_name`` is
+        its lower case name.
+
+    ``align``
+        ``libmarkdown.PARA`` for blocks rendered as paragraphs,
+        ``libmarkdown.CENTER`` for centered ones, or
+        ``libmarkdown.IMPLICIT``, i.e. tight list items.
+
+    ``level``
+        The level of headers, 1 to 6, and 0 for other blocks.
+
+    ``ident``
+        The class of ``>%class%`` blockquotes, or ``None``.
+
+    ``lines``
+        The lines of Markdown source of the block, as Discount left
+        them, i.e. without the ``#`` of headers or the indentation of
+        code.  Blocks made of other blocks, like lists, have none.
+
+    ``children``
+        The blocks this one is made of.
+    """
+    __slots__ = ('type', 'align', 'level', 'ident', 'lines', 'children')
+
+    def __init__(self, type, align, level, ident, lines, children):
+        self.type = type
+        self.align = align
+        self.level = level
+        self.ident = ident
+        self.lines = lines
+        self.children = children
+
+    @property
+    def type_name(self):
+        return TYPE_NAMES[self.type]
+
+    def walk(self):
+        """
+        Iterate over this node and all of its descendants, depth first.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def __repr__(self):
+        return '<Node %s%s lines=%d children=%d>' % (
+            self.type_name, ' h%d' % self.level if self.level else '',
+            len(self.lines), len(self.children))
+
+
+def iter_lines(line):
+    """
+    Iterate over the strings of a chain of ``libmarkdown.Line``
+    pointers.
+    """
+    while line:
+        text = line.contents.text
+        yield text.text[:text.size] if text.size > 0 else ''
+        line = line.contents.next
+
+
+def iter_paragraphs(paragraph, depth=0):
+    """
+    Iterate over a chain of ``libmarkdown.Paragraph`` pointers and
+    their descendants, depth first, yielding ``(depth, paragraph)``
+    tuples.  ``SOURCE`` paragraphs are skipped, and their children
+    yielded at their depth.
+    """
+    stack = []
+    while True:
+        while paragraph:
+            p = paragraph.contents
+            if p.typ == libmarkdown.SOURCE:
+                stack.append((depth, p.next))
+                paragraph = p.down
+                continue
+
+            yield depth, p
+            if p.down:
+                # Children first, then the siblings.
+                stack.append((depth, p.next))
+                depth += 1
+                paragraph = p.down
+            else:
+                paragraph = p.next
+        if not stack:
+            return
+        depth, paragraph = stack.pop()
+
+
+def iter_top_level(paragraph):
+    """
+    Iterate over a chain of ``libmarkdown.Paragraph`` pointers, and
+    the children of ``SOURCE`` paragraphs among them, yielding the
+    paragraphs.
+    """
+    while paragraph:
+        p = paragraph.contents
+        if p.typ == libmarkdown.SOURCE:
+            for child in iter_top_level(p.down):
+                yield child
+        else:
+            yield p
+        paragraph = p.next
+
+
+def build_tree(doc):
+    """
+    Return the top-level ``Node`` objects of a compiled
+    ``libmarkdown.Document`` pointer.
+    """
+    roots = []
+    parents = [roots]
+    for depth, p in iter_paragraphs(doc.contents.code):
+        del parents[depth + 1:]
+        children = []
+        parents[depth].append(Node(
+            p.typ, p.align,
+            p.hnumber if p.typ == libmarkdown.HDR else 0,
+            p.ident,
+            tuple(iter_lines(p.text)),
+            children,
+        ))
+        parents.append(children)
+    return roots
+
+
+class FlatTree(object):
+    """
+    The blocks of a compiled document as parallel ``array.array``
+    columns, in depth first order; the ``i``-th block is described by
+    the ``i``-th item of each column.
+
+    ``types``
+        The ``Paragraph.typ`` of each block.
+
+    ``parents``
+        The index of the parent of each block, or -1 for top-level
+        blocks.
+
+    ``depths``
+        The nesting depth of each block, 0 for top-level blocks.
+
+    ``levels``
+        The level of headers, and 0 for other blocks.
+
+    ``offsets`` and ``lengths``
+        The position of the lines of each block, joined by newlines, in
+        the ``text`` string shared by all blocks.
+    """
+    __slots__ = ('types', 'parents', 'depths', 'levels', 'offsets',
+                 'lengths', 'text')
+
+    def __init__(self):
+        self.types = array.array('b')
+        self.parents = array.array('i')
+        self.depths = array.array('H')
+        self.levels = array.array('b')
+        self.offsets = array.array('L')
+        self.lengths = array.array('L')
+        self.text = ''
+
+    def __len__(self):
+        return len(self.types)
+
+    def text_of(self, index):
+        """
+        Return the text of the block at ``index``.
+        """
+        offset = self.offsets[index]
+        return self.text[offset:offset + self.lengths[index]]
+
+    def type_counts(self):
+        """
+        Return the number of blocks of each type, as a dict keyed by
+        type name.
+        """
+        return dict(
+            (TYPE_NAMES[type_], count)
+            for type_, count in collections.Counter(self.types).iteritems())
+
+    def heading_counts(self):
+        """
+        Return the number of headers of each level, as a dict.
+        """
+        counts = collections.Counter(self.levels)
+        counts.pop(0, None)
+        return dict(counts)
+
+    def max_depth(self):
+        """
+        Return the deepest nesting depth, or -1 for an empty document.
+        """
+        return max(self.depths) if self.depths else -1
+
+
+def build_flat_tree(doc):
+    """
+    Return a ``FlatTree`` for a compiled ``libmarkdown.Document``
+    pointer.
+    """
+    flat = FlatTree()
+    chunks = []
+    offset = 0
+    last = []
+
+    for depth, p in iter_paragraphs(doc.contents.code):
+        del last[depth:]
+        flat.parents.append(last[-1] if last else -1)
+        last.append(len(flat.types))
+
+        text = '\n'.join(iter_lines(p.text))
+        chunks.append(text)
+        flat.types.append(p.typ)
+        flat.depths.append(depth)
+        flat.levels.append(p.hnumber if p.typ == libmarkdown.HDR else 0)
+        flat.offsets.append(offset)
+        flat.lengths.append(len(text))
+        offset += len(text)
+
+    flat.text = ''.join(chunks)
+    return flat
+
+
+_ANCHOR_TABLE = string.maketrans(' &<"', '----')
+
+
+def anchor(text):
+    """
+    Return the id Discount gives to a header with the source ``text``
+    when rendering with ``MKD_TOC``.
+    """
+    return text.translate(_ANCHOR_TABLE)
+
+
+def build_outline(doc):
+    """
+    Return the top-level headers of a compiled ``libmarkdown.Document``
+    pointer, as a list of ``(level, anchor_id, text)`` tuples.  These
+    are the headers listed in the table of contents.
+    """
+    outline = []
+    for p in iter_top_level(doc.contents.code):
+        if p.typ == libmarkdown.HDR and p.text:
+            text = next(iter_lines(p.text))
+            outline.append((p.hnumber, anchor(text), text))
+    return outline
+
+
+class Link(object):
+    """
+    A url found in a document.
+
+    ``kind`` is ``'link'`` or ``'image'`` for inline ``[]()`` and
+    ``![]()`` links, ``'autolink'`` for ``<url>`` links and, with
+    ``MKD_AUTOLINK``, bare urls, and ``'reference'`` for reference
+    definitions, whose ``label`` is also set.
+    """
+    __slots__ = ('kind', 'url', 'title', 'width', 'height', 'label')
+
+    def __init__(self, kind, url, title='', width=0, height=0, label=None):
+        self.kind = kind
+        self.url = url
+        self.title = title
+        self.width = width
+        self.height = height
+        self.label = label
+
+    def __repr__(self):
+        return '<Link %s %r>' % (self.kind, self.url)
+
+
+_CODE_SPAN = re.compile(r'(`+)(.+?)\1', re.S)
+_LINK_START = re.compile(r'(!?)\[((?:[^\[\]]|\[[^\[\]]*\])*)\]\(')
+_LINK_END = re.compile(
+    r'''(?:\s+=(\d*)x(\d*))?(?:\s+(["'])(.*?)\3)?\s*\)''', re.S)
+_AUTOLINK = re.compile(
+    r'<((?:https?|ftp|news)://[^>\s]+|mailto:[^>\s]+|[^@<>\s]+@[^<>\s]+)>')
+_BARE_URL = re.compile(r'(?:https?|ftp|news)://[^\s<>()]+')
+
+# Blocks whose lines can hold links.
+_LINK_TYPES = frozenset([
+    libmarkdown.MARKUP, libmarkdown.HDR, libmarkdown.TABLE,
+    libmarkdown.LISTITEM,
+])
+
+
+def _cstring(cstring):
+    return cstring.text[:cstring.size] if cstring.size > 0 else ''
+
+
+def _link_destination(text, pos):
+    # Parse the ``url =WxH "title")`` end of an inline link, starting
+    # right after its opening parenthesis, and return the url, size,
+    # title and end of the link, or ``None``.  Like Discount, urls may
+    # hold balanced parentheses, or anything but ``>`` within ``<>``.
+    while pos < len(text) and text[pos].isspace():
+        pos += 1
+
+    if text.startswith('<', pos):
+        end = text.find('>', pos)
+        if end == -1:
+            return None
+        url = text[pos + 1:end]
+        pos = end + 1
+    else:
+        start = pos
+        depth = 0
+        while pos < len(text) and not text[pos].isspace():
+            if text[pos] == '(':
+                depth += 1
+            elif text[pos] == ')':
+                if not depth:
+                    break
+                depth -= 1
+            pos += 1
+        url = text[start:pos]
+
+    match = _LINK_END.match(text, pos)
+    if match is None:
+        return None
+    width, height = match.group(1, 2)
+    return (url, int(width or 0), int(height or 0), match.group(4) or '',
+            match.end())
+
+
+def _sub_inline_links(repl, text):
+    # Like ``re.subn()``, for the ``[]()`` and ``![]()`` links of
+    # ``text``.  ``repl`` is called with the match of the ``[text]``
+    # part, the url, width, height and title.
+    parts = []
+    count = 0
+    pos = 0
+    match = _LINK_START.search(text)
+    while match is not None:
+        destination = _link_destination(text, match.end())
+        if destination is None:
+            match = _LINK_START.search(text, match.start() + 1)
+            continue
+
+        parts.append(text[pos:match.start()])
+        parts.append(repl(match, *destination[:4]))
+        pos = destination[4]
+        count += 1
+        match = _LINK_START.search(text, pos)
+
+    parts.append(text[pos:])
+    return ''.join(parts), count
+
+
+def _inline_links(text, flags):
+    links = []
+
+    def link(match, url, width, height, title):
+        links.append(Link(
+            'image' if match.group(1) else 'link',
+            url, title, width, height,
+        ))
+        # Keep the text, which may hold an image.
+        return match.group(2)
+
+    text = _CODE_SPAN.sub('', text)
+    while True:
+        text, count = _sub_inline_links(link, text)
+        if not count:
+            break
+
+    def autolink(match):
+        links.append(Link('autolink', match.group(1)))
+        return ''
+
+    text = _AUTOLINK.sub(autolink, text)
+    if flags & libmarkdown.MKD_AUTOLINK:
+        links.extend(
+            Link('autolink', url) for url in _BARE_URL.findall(text))
+    return links
+
+
+def build_links(doc, flags=0):
+    """
+    Return the urls of a compiled ``libmarkdown.Document`` pointer as
+    a list of ``Link`` objects: the inline links, images and autolinks
+    block by block, followed by the reference definitions.
+
+    Reference definitions are read from the table Discount builds when
+    compiling; the other links are found in the source lines of every
+    block other than code and html.
+    """
+    links = []
+    for depth, p in iter_paragraphs(doc.contents.code):
+        if p.typ in _LINK_TYPES and p.text:
+            links.extend(_inline_links('\n'.join(iter_lines(p.text)), flags))
+
+    ctx = doc.contents.ctx
+    if ctx and ctx.contents.footnotes:
+        table = ctx.contents.footnotes.contents
+        for i in xrange(table.size):
+            footnote = table.text[i]
+            label = _cstring(footnote.tag)
+            if label.startswith('[') and label.endswith(']'):
+                label = label[1:-1]
+            links.append(Link(
+                'reference', _cstring(footnote.link),
+                _cstring(footnote.title), footnote.width, footnote.height,
+                label,
+            ))
+    return links
+
+
+_ESCAPE = re.compile(r'\\([\\`*_{}\[\]()#+\-.!<>])')
+_PLACEHOLDER = re.compile('\x00(\\d+)\x00')
+_REFERENCE_STYLE_LINK = re.compile(
+    r'''!?\[((?:[^\[\]]|\[[^\[\]]*\])*)\]\s?\[([^\[\]]*)\]''')
+_REFERENCE_LINK = re.compile(r'\[([^\[\]]+)\]')
+_HTML_COMMENT = re.compile(r'<!--.*?-->', re.S)
+# Unclosed script and style elements run to the end of the text.
+_SCRIPT_OR_STYLE = re.compile(
+    r'<(script|style)\b[^>]*>.*?(?:</\1\s*>|\Z)', re.S | re.I)
+_TAG = re.compile(r'</?[A-Za-z][^>]*>')
+_EMPHASIS = re.compile(
+    r'(\*{1,3})(?=\S)(.+?)(?<=\S)\1|'
+    r'(?<!\w)(_{1,3})(?=\S)(.+?)(?<=\S)\3(?!\w)',
+    re.S
+)
+_TABLE_SEPARATOR = re.compile(r'^[\s|:-]+$')
+_DL_TERM = re.compile(r'^=(.*)=$')
+_ENTITY = re.compile(
+    r'&(?:#[xX]([0-9a-fA-F]{1,6})|#([0-9]{1,7})|([A-Za-z][A-Za-z0-9]*));')
+
+# Loaded when first needed, from ``htmlentitydefs``.
+_entity_codepoints = None
+
+
+def _entity(match):
+    global _entity_codepoints
+    hexadecimal, decimal, name = match.groups()
+    if name is None:
+        code = int(hexadecimal, 16) if hexadecimal else int(decimal)
+        if code == 0:
+            code = 0xfffd
+    else:
+        if _entity_codepoints is None:
+            import htmlentitydefs
+            _entity_codepoints = dict(
+                htmlentitydefs.name2codepoint, apos=ord("'"))
+        code = _entity_codepoints.get(name)
+        if code is None:
+            return match.group(0)
+    try:
+        return unichr(code).encode('utf-8')
+    except ValueError:
+        return match.group(0)
+
+
+def _unescape(text):
+    # Entities are replaced in the bytes themselves, so the rest of the
+    # text is kept as is whatever its encoding; the characters they
+    # stand for are encoded as UTF-8.
+    if '&' not in text:
+        return text
+    return _ENTITY.sub(_entity, text)
+
+
+def _normalize_label(label):
+    # Discount compares labels ignoring case, with any whitespace
+    # character matching any other.
+    return re.sub(r'\s', ' ', label.lower())
+
+
+def _references(doc):
+    # The normalized labels of the reference definitions.
+    labels = set()
+    ctx = doc.contents.ctx
+    if ctx and ctx.contents.footnotes:
+        table = ctx.contents.footnotes.contents
+        for i in xrange(table.size):
+            label = _cstring(table.text[i].tag)
+            if label.startswith('[') and label.endswith(']'):
+                label = label[1:-1]
+            labels.add(_normalize_label(label))
+    return labels
+
+
+def _strip_html(text):
+    # Remove tags and comments, and the contents of the elements which
+    # are not displayed.
+    text = _HTML_COMMENT.sub('', text)
+    text = _SCRIPT_OR_STYLE.sub('', text)
+    return _TAG.sub('', text)
+
+
+def _link_text(match, *destination):
+    return match.group(2)
+
+
+def _sub_reference_links(text, references):
+    # Replace the ``[text][id]`` links of ``text`` whose id is defined
+    # with their text, and return the new text and the number of links
+    # replaced.  Discount leaves the others as they are.
+    parts = []
+    count = 0
+    pos = 0
+    match = _REFERENCE_STYLE_LINK.search(text)
+    while match is not None:
+        label = match.group(2) or match.group(1)
+        if _normalize_label(label) not in references:
+            match = _REFERENCE_STYLE_LINK.search(text, match.start() + 1)
+            continue
+
+        parts.append(text[pos:match.start()])
+        parts.append(match.group(1))
+        pos = match.end()
+        count += 1
+        match = _REFERENCE_STYLE_LINK.search(text, pos)
+
+    parts.append(text[pos:])
+    return ''.join(parts), count
+
+
+def plain_inline(text, references=()):
+    """
+    Return the visible text of a span of Markdown: emphasis, link and
+    image syntax, html tags and code span markers are removed, and
+    backslash escapes and entities are resolved.  ``references`` are
+    the labels of the reference definitions of the document.
+    """
+    # Code spans and escaped characters are set aside first, so none
+    # of the rules below apply to them.
+    protected = []
+
+    def protect(text):
+        protected.append(text)
+        return '\x00%d\x00' % (len(protected) - 1)
+
+    text = _ESCAPE.sub(lambda match: protect(match.group(1)), text)
+    text = _CODE_SPAN.sub(
+        lambda match: protect(match.group(2).strip()), text)
+
+    text = _AUTOLINK.sub(lambda match: protect(match.group(1)), text)
+    text = _strip_html(text)
+
+    while True:
+        text, count = _sub_inline_links(_link_text, text)
+        text, references_count = _sub_reference_links(text, references)
+        if not count and not references_count:
+            break
+
+    def reference(match):
+        label = match.group(1)
+        if _normalize_label(label) in references:
+            return label
+        return match.group(0)
+
+    text = _REFERENCE_LINK.sub(reference, text)
+
+    while True:
+        text, count = _EMPHASIS.subn(
+            lambda match: match.group(2) or match.group(4), text)
+        if not count:
+            break
+
+    text = _unescape(text)
+    return _PLACEHOLDER.sub(lambda match: protected[int(match.group(1))], text)
+
+
+def _plain_block(p, parent_type, references):
+    typ = p.typ
+    lines = list(iter_lines(p.text))
+
+    if typ == libmarkdown.CODE:
+        return '\n'.join(lines)
+    if typ == libmarkdown.HTML:
+        text = _strip_html('\n'.join(lines))
+        text = _unescape(text)
+        return '\n'.join(line.strip() for line in text.split('\n')
+                         if line.strip())
+    if typ == libmarkdown.TABLE:
+        return '\n'.join(
+            ' '.join(plain_inline(cell.strip(), references)
+                     for cell in line.strip().strip('|').split('|'))
+            for line in lines if not _TABLE_SEPARATOR.match(line))
+    if typ == libmarkdown.LISTITEM and parent_type == libmarkdown.DL:
+        lines = [_DL_TERM.sub(r'\1', line.strip()) for line in lines]
+    return plain_inline(' '.join(line.strip() for line in lines), references)
+
+
+# Blocks which have no visible text of their own.
+_INVISIBLE_TYPES = frozenset([
+    libmarkdown.STYLE, libmarkdown.HR, libmarkdown.WHITESPACE,
+])
+
+
+def iter_plain_text(doc):
+    """
+    Iterate over the visible text of a compiled ``libmarkdown.Document``
+    pointer, block by block.  Each string is the text of a block,
+    followed by a newline.
+    """
+    references = _references(doc)
+    types = []
+    for depth, p in iter_paragraphs(doc.contents.code):
+        del types[depth:]
+        types.append(p.typ)
+        if p.typ in _INVISIBLE_TYPES or not p.text:
+            continue
+
+        text = _plain_block(p, types[-2] if depth else None, references)
+        if text:
+            yield text + '\n'
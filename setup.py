@@ -149,6 +149,11 @@ setup(
     py_modules=[
         'discount',
         'discount.libmarkdown',
+        'discount.cache',
+        'discount.links',
+        'discount.blocks',
+        'discount.tree',
+        'discount.corpus',
     ],
 
     ext_modules=[
@@ -1,14 +1,48 @@
 import ctypes
 import ctypes.util
+import mmap
+import os
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import StringIO
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
-from discount import Markdown, libmarkdown
+import discount
+
+from discount import (
+    Markdown, Renderer, libmarkdown, render_inline, render_inline_many,
+    render_many)
+from discount.blocks import (
+    IncrementalDocument, find_references, render_sharded, split_blocks)
+from discount.cache import DiskCache, MemoizedLinkCallback, RenderCache
+from discount.corpus import CorpusRenderer
+from discount.links import LinkRules
+from discount.tree import plain_inline
 
 
 libc = ctypes.CDLL(ctypes.util.find_library('c'))
 
 
+def run_python(code):
+    return subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+
+
+def add_basepath(url):
+    if url.startswith('/'):
+        return 'http://example.com%s' % url
+
+
 class LibmarkdownTestCase(unittest.TestCase):
     def test_pythonapi(self):
         self.assertEqual(
@@ -887,6 +921,52 @@ class LibmarkdownTestCase(unittest.TestCase):
         out.close()
 
 
+class LazyLoadingTestCase(unittest.TestCase):
+    def test_import_does_not_load_library(self):
+        out = run_python(
+            'import discount\n'
+            'print discount.libmarkdown._so is None'
+        )
+        self.assertEqual(out.strip(), 'True')
+
+    def test_import_is_lean(self):
+        out = run_python(
+            'import sys\n'
+            'import discount\n'
+            'print sorted(name for name in (\n'
+            '    "ctypes.util", "subprocess", "tempfile", "sqlite3",\n'
+            '    "HTMLParser", "discount.cache", "discount.tree",\n'
+            ') if name in sys.modules)'
+        )
+        self.assertEqual(out.strip(), '[]')
+
+    def test_markdown_version_loads_library(self):
+        out = run_python(
+            'import discount\n'
+            'print bool(discount.libmarkdown.markdown_version)\n'
+            'print discount.libmarkdown._so is None'
+        )
+        self.assertEqual(out.split(), ['True', 'False'])
+
+    def test_concurrent_first_use(self):
+        out = run_python(
+            'import threading, discount\n'
+            'results = []\n'
+            'def render():\n'
+            '    results.append(discount.Markdown("`test`").get_html_content())\n'
+            'threads = [threading.Thread(target=render) for _ in range(8)]\n'
+            'for thread in threads: thread.start()\n'
+            'for thread in threads: thread.join()\n'
+            'print len(set(results)), len(results)'
+        )
+        self.assertEqual(out.split(), ['1', '8'])
+
+    def test_functions_are_bound_after_load(self):
+        libmarkdown.load()
+        self.assertTrue(
+            isinstance(libmarkdown.mkd_string, ctypes._CFuncPtr))
+
+
 class MarkdownClassTestCase(unittest.TestCase):
     def test_fails_without_args(self):
         self.assertRaises(TypeError, Markdown)
@@ -1324,6 +1404,35 @@ class MarkdownClassTestCase(unittest.TestCase):
             '</p>'
         )
 
+    def test_close(self):
+        md = Markdown('[a](/a.html)', rewrite_links_func=add_basepath)
+        md.get_html_content()
+        handle = md._link_callback_handle
+        md.close()
+        md.close()
+
+        self.assertFalse(hasattr(md, '_doc'))
+        self.assertFalse(handle in discount._link_callbacks)
+        self.assertRaises(ValueError, md.get_html_content)
+
+    def test_context_manager(self):
+        with Markdown('`test`') as md:
+            self.assertEqual(
+                md.get_html_content(), '<p><code>test</code></p>')
+        self.assertRaises(ValueError, md.get_html_content)
+
+    def test_results_outlive_close(self):
+        with Markdown('`test`') as md:
+            result = md.render()
+            buf = md.get_html_content_buffer()
+            chunks = md.iter_html_content(chunk_size=4)
+            first = next(chunks)
+
+        self.assertFalse(hasattr(md, '_doc'))
+        self.assertEqual(result.content, '<p><code>test</code></p>')
+        self.assertEqual(buf.raw, '<p><code>test</code></p>')
+        self.assertEqual(first + ''.join(chunks), '<p><code>test</code></p>')
+
     def test_empty_document_renders(self):
         md = Markdown('')
         html = md.get_html_content()
@@ -1348,5 +1457,1265 @@ class MarkdownClassTestCase(unittest.TestCase):
         self.assertEqual(html, '')
 
 
+class CallbackArenaTestCase(unittest.TestCase):
+    def test_carve(self):
+        arena = discount._CallbackArena(size=16)
+        a = arena.carve('http://example.com/a')
+        b = arena.carve('b')
+        self.assertEqual(ctypes.string_at(a), 'http://example.com/a')
+        self.assertEqual(ctypes.string_at(b), 'b')
+
+    def test_reset_keeps_one_block(self):
+        arena = discount._CallbackArena(size=16, max_retained=128)
+        for _ in range(10):
+            arena.carve('x' * 10)
+        block = arena._block
+        arena.reset()
+        self.assertTrue(arena._block is block)
+        self.assertEqual(arena._retired, [])
+
+        arena.carve('x' * 200)
+        arena.reset()
+        self.assertEqual(arena._block, None)
+
+    def test_reset_after_render(self):
+        md = Markdown('[a](/a.html)', rewrite_links_func=add_basepath)
+        md.get_html_content()
+        self.assertEqual(md._arena._offset, 0)
+        self.assertEqual(md._arena._pinned, [])
+
+    def test_memory_stays_flat(self):
+        text = '\n'.join('[%d](/%d.html)' % (i, i) for i in range(500))
+
+        def long_url(url):
+            return 'http://example.com%s?%s' % (url, 'x' * 1000)
+
+        def render(count):
+            for _ in range(count):
+                md = Markdown(text, rewrite_links_func=long_url)
+                md.get_html_content()
+                md.get_html_toc()
+
+        render(20)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        render(500)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # About 250MB of callback results went through the arenas
+        self.assertTrue(after - before < 4 * 1024, (before, after))
+
+
+class LinkCallbackThunksTestCase(unittest.TestCase):
+    def test_no_function_pointer_per_document(self):
+        md = Markdown('[a](/a.html)', rewrite_links_func=add_basepath)
+
+        @md.link_attrs
+        def link_attrs_func(url):
+            return 'target="_blank"'
+
+        for value in vars(md).values():
+            self.assertFalse(isinstance(value, ctypes._CFuncPtr))
+
+    def test_registered_until_deleted(self):
+        md = Markdown('[a](/a.html)', rewrite_links_func=add_basepath)
+        self.assertEqual(
+            md.get_html_content(),
+            '<p><a href="http://example.com/a.html">a</a></p>'
+        )
+
+        handle = md._link_callback_handle
+        self.assertTrue(handle in discount._link_callbacks)
+        del md
+        self.assertFalse(handle in discount._link_callbacks)
+
+    def test_documents_keep_their_callbacks(self):
+        first = Markdown('[a](/a.html)', rewrite_links_func=add_basepath)
+        second = Markdown('[a](/a.html)', rewrite_links_func=str.upper)
+        first._get_compiled_doc()
+        second._get_compiled_doc()
+
+        self.assertEqual(
+            second.get_html_content(), '<p><a href="/A.HTML">a</a></p>')
+        self.assertEqual(
+            first.get_html_content(),
+            '<p><a href="http://example.com/a.html">a</a></p>'
+        )
+
+
+class TreeTestCase(unittest.TestCase):
+    text = (
+        '# Title #\n\n'
+        'A *paragraph*\non two lines.\n\n'
+        '* a\n* b\n\n'
+        '> quote\n\n'
+        '    code\n\n'
+        '<div>\nhtml\n</div>\n\n'
+        'Sub title\n---------\n'
+    )
+
+    def test_get_tree(self):
+        nodes = Markdown(self.text).get_tree()
+        self.assertEqual(
+            [node.type_name for node in nodes],
+            ['hdr', 'markup', 'ul', 'quote', 'code', 'html', 'hdr']
+        )
+
+        title, paragraph, ul, quote, code, html, subtitle = nodes
+        self.assertEqual((title.level, title.lines), (1, ('Title',)))
+        self.assertEqual(
+            (subtitle.level, subtitle.lines), (2, ('Sub title',)))
+        self.assertEqual(
+            paragraph.lines, ('A *paragraph*', 'on two lines.'))
+        self.assertEqual(paragraph.align, libmarkdown.PARA)
+        self.assertEqual(code.lines, ('code',))
+        self.assertEqual(html.lines, ('<div>', 'html', '</div>'))
+
+        self.assertEqual(
+            [item.type for item in ul.children],
+            [libmarkdown.LISTITEM, libmarkdown.LISTITEM]
+        )
+        self.assertEqual(
+            [[child.lines for child in item.children]
+             for item in ul.children],
+            [[('a',)], [('b',)]]
+        )
+        self.assertEqual(
+            [child.lines for child in quote.children], [('quote',)])
+
+    def test_walk(self):
+        nodes = Markdown('* a\n\n    > b\n').get_tree()
+        self.assertEqual(
+            [node.type_name for node in nodes[0].walk()],
+            ['ul', 'listitem', 'markup', 'quote', 'markup']
+        )
+
+    def test_no_html_generated(self):
+        md = Markdown(self.text)
+        md.get_tree()
+        self.assertEqual(md._get_compiled_doc().contents.html, 0)
+
+    def test_empty_document(self):
+        self.assertEqual(Markdown('').get_tree(), [])
+
+    def test_get_flat_tree(self):
+        md = Markdown(self.text)
+        flat = md.get_flat_tree()
+        nodes = [node for root in md.get_tree() for node in root.walk()]
+
+        self.assertEqual(len(flat), len(nodes))
+        self.assertEqual(list(flat.types), [node.type for node in nodes])
+        self.assertEqual(list(flat.levels), [node.level for node in nodes])
+        self.assertEqual(
+            [flat.text_of(i) for i in range(len(flat))],
+            ['\n'.join(node.lines) for node in nodes]
+        )
+        self.assertEqual(
+            [nodes[i].type_name if i >= 0 else None for i in flat.parents],
+            [None, None, None, 'ul', 'listitem', 'ul', 'listitem', None,
+             'quote', None, None, None]
+        )
+
+    def test_flat_tree_statistics(self):
+        flat = Markdown(self.text).get_flat_tree()
+        self.assertEqual(flat.max_depth(), 2)
+        self.assertEqual(flat.heading_counts(), {1: 1, 2: 1})
+        self.assertEqual(flat.type_counts()['listitem'], 2)
+        self.assertEqual(Markdown('').get_flat_tree().max_depth(), -1)
+
+
+class OutlineTestCase(unittest.TestCase):
+    text = (
+        '% Title\n% Author\n% Date\n\n'
+        '# A "quoted" & <tagged> *header* #\n\n'
+        'text\n\n'
+        'Setext header\n-------------\n\n'
+        '> # Not in the outline\n\n'
+        '<div>\nhtml\n</div>\n\n'
+        '### Third level\n'
+    )
+
+    def test_get_outline(self):
+        self.assertEqual(
+            Markdown(self.text).get_outline(),
+            [
+                (1, 'A--quoted-----tagged>-*header*',
+                 'A "quoted" & <tagged> *header*'),
+                (2, 'Setext-header', 'Setext header'),
+                (3, 'Third-level', 'Third level'),
+            ]
+        )
+
+    def test_matches_rendered_ids(self):
+        html = Markdown(self.text, toc=True).get_html_content()
+        rendered = re.findall(r'<h([1-6]) id="(.*?)">', html)
+        self.assertEqual(
+            [(level, anchor)
+             for level, anchor, text in Markdown(self.text).get_outline()],
+            [(int(level), anchor) for level, anchor in rendered
+             if anchor != 'Not-in-the-outline']
+        )
+
+    def test_no_html_generated(self):
+        md = Markdown(self.text)
+        md.get_outline()
+        self.assertEqual(md._get_compiled_doc().contents.html, 0)
+
+
+class LinksTestCase(unittest.TestCase):
+    text = (
+        '# A [header link](/header.html)\n\n'
+        'A [link](/a.html "Title"), ![image](/i.png =10x20 "Image"),\n'
+        '`[code](/code.html)` and <http://example.com/auto>.\n\n'
+        '    [indented](/code-block.html)\n\n'
+        '* [reference][Ref] in a list\n\n'
+        '<div><a href="/html.html">html</a></div>\n\n'
+        'http://example.com/bare\n\n'
+        '[ref]: http://example.com/ref "Reference"\n'
+        '[img]: /img.png =30x40\n'
+    )
+
+    def links(self, md):
+        return [
+            (link.kind, link.url, link.title, link.width, link.height,
+             link.label)
+            for link in md.get_links()
+        ]
+
+    def test_get_links(self):
+        self.assertEqual(
+            self.links(Markdown(self.text)),
+            [
+                ('link', '/header.html', '', 0, 0, None),
+                ('link', '/a.html', 'Title', 0, 0, None),
+                ('image', '/i.png', 'Image', 10, 20, None),
+                ('autolink', 'http://example.com/auto', '', 0, 0, None),
+                ('reference', '/img.png', '', 30, 40, 'img'),
+                ('reference', 'http://example.com/ref', 'Reference', 0, 0,
+                 'ref'),
+            ]
+        )
+
+    def test_autolink_flag(self):
+        links = self.links(Markdown(self.text, autolink=True))
+        self.assertTrue(
+            ('autolink', 'http://example.com/bare', '', 0, 0, None) in links)
+
+    def test_no_references(self):
+        self.assertEqual(self.links(Markdown('')), [])
+        self.assertEqual(
+            self.links(Markdown('[a](/a.html)')),
+            [('link', '/a.html', '', 0, 0, None)]
+        )
+
+    def test_parenthesized_urls(self):
+        text = (
+            '[W](http://en.wikipedia.org/wiki/Foo_(bar)) and '
+            '[this](http://a.com/?q=(1)), [a](<http://x y>) and '
+            '![i](/i.png "Title (1)")'
+        )
+        self.assertEqual(
+            self.links(Markdown(text)),
+            [
+                ('link', 'http://en.wikipedia.org/wiki/Foo_(bar)', '', 0, 0,
+                 None),
+                ('link', 'http://a.com/?q=(1)', '', 0, 0, None),
+                ('link', 'http://x y', '', 0, 0, None),
+                ('image', '/i.png', 'Title (1)', 0, 0, None),
+            ]
+        )
+
+    def test_no_html_generated(self):
+        md = Markdown(self.text)
+        md.get_links()
+        self.assertEqual(md._get_compiled_doc().contents.html, 0)
+
+
+class PlainTextTestCase(unittest.TestCase):
+    text = (
+        '# A *header*\n\n'
+        'Some **bold**, _emphasized_ and `co*de*` text, a [link](/a.html),\n'
+        'an ![image](/i.png) and a [reference][ref] to AT&amp;T.\n\n'
+        '* <b>one</b>\n'
+        '* two\n\n'
+        '    code_block(*args)\n\n'
+        '> quoted \\*text\\*\n\n'
+        '<div>\n<p>html &amp; text</p>\n</div>\n\n'
+        '[ref]: http://example.com/ref\n'
+    )
+    plain_text = (
+        'A header\n'
+        'Some bold, emphasized and co*de* text, a link, an image and a '
+        'reference to AT&T.\n'
+        'one\n'
+        'two\n'
+        'code_block(*args)\n'
+        'quoted *text*\n'
+        'html & text\n'
+    )
+
+    def test_get_plain_text(self):
+        self.assertEqual(Markdown(self.text).get_plain_text(), self.plain_text)
+
+    def test_plain_inline(self):
+        self.assertEqual(
+            plain_inline(
+                '[![nested](/n.png)](/n.html) snake_case_word <!-- x --> '
+                '<http://example.com/> [undefined]'),
+            'nested snake_case_word  http://example.com/ [undefined]'
+        )
+
+    def test_parenthesized_urls(self):
+        self.assertEqual(
+            plain_inline(
+                'see [Wikipedia](http://en.wikipedia.org/wiki/Foo_(bar)) now'),
+            'see Wikipedia now'
+        )
+
+    def test_undefined_references_kept(self):
+        self.assertEqual(plain_inline('Press [Ctrl] [C]'), 'Press [Ctrl] [C]')
+        self.assertEqual(plain_inline('[a] [b]', set(['b'])), 'a')
+        self.assertEqual(plain_inline('[a][]', set(['a'])), 'a')
+
+    def test_bytes_kept(self):
+        # Text in another encoding than UTF-8 is left untouched.
+        self.assertEqual(
+            plain_inline('caf\xe9 &amp; cr\xe8me &eacute; &#233; &bogus;'),
+            'caf\xe9 & cr\xe8me \xc3\xa9 \xc3\xa9 &bogus;'
+        )
+
+    def test_script_and_style_dropped(self):
+        self.assertEqual(
+            plain_inline(
+                'AT&T <script>alert(1)</script><style>p {}</style>'),
+            'AT&T '
+        )
+        self.assertEqual(
+            Markdown(
+                '<div>\n<script>\nalert(1)\n</script>\n<p>text</p>\n'
+                '</div>\n'
+            ).get_plain_text(),
+            'text\n'
+        )
+
+    def test_write_plain_text(self):
+        md = Markdown(self.text)
+
+        out = StringIO.StringIO()
+        md.write_plain_text(out)
+        self.assertEqual(out.getvalue(), self.plain_text)
+
+        out = tempfile.TemporaryFile('r+w')
+        md.write_plain_text(out.fileno())
+        out.seek(0)
+        self.assertEqual(out.read(), self.plain_text)
+
+    def test_no_html_generated(self):
+        md = Markdown(self.text)
+        md.get_plain_text()
+        self.assertEqual(md._get_compiled_doc().contents.html, 0)
+
+
+class RenderResultTestCase(unittest.TestCase):
+    text = (
+        '% abc\n% def\n% jhi\n'
+        '<style>\n  *{color:red}\n</style>\n\n'
+        '# header-1\n\n`test`'
+    )
+
+    def test_matches_getters(self):
+        result = Markdown(self.text).render()
+        md = Markdown(self.text, toc=True)
+
+        self.assertEqual(result.content, md.get_html_content())
+        self.assertEqual(result.toc, md.get_html_toc())
+        self.assertEqual(result.css, md.get_html_css())
+        self.assertEqual(result.title, 'abc')
+        self.assertEqual(result.author, 'def')
+        self.assertEqual(result.date, 'jhi')
+
+    def test_compiles_with_toc(self):
+        result = Markdown('# header-1').render()
+        self.assertEqual(result.content, '<h1 id="header-1">header-1</h1>')
+        self.assertTrue('<a href="#header-1">' in result.toc)
+
+    def test_empty_document(self):
+        result = Markdown('').render()
+        self.assertEqual(
+            (result.content, result.toc, result.css, result.title),
+            ('', '', '', None)
+        )
+
+    def test_slots(self):
+        result = Markdown(self.text).render()
+        self.assertRaises(AttributeError, setattr, result, 'other', 1)
+
+    def test_toc_and_css_are_freed(self):
+        # Discount allocates the table of contents and style blocks
+        # for the caller on every call.
+        text = '\n\n'.join(
+            ['<style>%s</style>' % ('p {}' * 25000)] +
+            ['# header %d' % i for i in range(2000)]
+        )
+
+        def render(count):
+            for _ in range(count):
+                md = Markdown(text, toc=True)
+                md.render()
+                md.get_html_toc()
+                md.get_html_css()
+                md.write_html_toc(StringIO.StringIO())
+                md.write_html_css(StringIO.StringIO())
+
+        render(5)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        render(50)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # Over 30MB would leak otherwise.
+        self.assertTrue(after - before < 8 * 1024, (before, after))
+
+
+class BufferInputTestCase(unittest.TestCase):
+    def test_bytearray(self):
+        md = Markdown(bytearray('`test`'))
+        self.assertEqual(md.get_html_content(), '<p><code>test</code></p>')
+
+    def test_memoryview(self):
+        md = Markdown(memoryview('*a* `test` *b*')[4:10])
+        self.assertEqual(md.get_html_content(), '<p><code>test</code></p>')
+
+    def test_buffer(self):
+        md = Markdown(buffer('`test`'))
+        self.assertEqual(md.get_html_content(), '<p><code>test</code></p>')
+
+    def test_mmap(self):
+        i = tempfile.TemporaryFile('r+w')
+        i.write('`test`')
+        i.flush()
+        m = mmap.mmap(i.fileno(), 0, access=mmap.ACCESS_READ)
+        md = Markdown(m)
+        self.assertEqual(md.get_html_content(), '<p><code>test</code></p>')
+        m.close()
+        i.close()
+
+    def test_empty(self):
+        self.assertEqual(Markdown(bytearray()).get_html_content(), '')
+
+
+class FromChunksTestCase(unittest.TestCase):
+    def test_from_chunks(self):
+        md = Markdown.from_chunks(iter(['# head', 'er-1\n', '\n`te', 'st`']))
+        self.assertEqual(
+            md.get_html_content(),
+            '<h1>header-1</h1>\n\n<p><code>test</code></p>'
+        )
+
+    def test_large_input(self):
+        # More than fits in a pipe's buffer at once
+        chunks = ('`%d`\n\n' % i for i in xrange(100000))
+        html = Markdown.from_chunks(chunks).get_html_content()
+        self.assertEqual(
+            html,
+            '\n\n'.join('<p><code>%d</code></p>' % i for i in xrange(100000))
+        )
+
+    def test_kwargs_flags(self):
+        md = Markdown.from_chunks(['<b>', 'a</b>'], ignore_embedded_html=True)
+        self.assertEqual(md.get_html_content(), '<p>&lt;b>a&lt;/b></p>')
+
+    def test_empty(self):
+        self.assertEqual(Markdown.from_chunks([]).get_html_content(), '')
+
+    def test_errors_are_raised(self):
+        def chunks():
+            yield '`test`'
+            raise KeyError('chunk')
+
+        md = Markdown.from_chunks(chunks())
+        self.assertRaises(KeyError, md.get_html_content)
+        # The chunks are consumed; the rest isn't rendered on its own.
+        self.assertRaises(KeyError, md.get_html_content)
+
+
+class FromPathTestCase(unittest.TestCase):
+    def _path(self, text):
+        fp = tempfile.NamedTemporaryFile()
+        fp.write(text)
+        fp.flush()
+        return fp
+
+    def test_from_path(self):
+        fp = self._path('# header-1\n\n`test`')
+        md = Markdown.from_path(fp.name, toc=True)
+        self.assertEqual(
+            md.get_html_content(),
+            '<h1 id="header-1">header-1</h1>\n\n<p><code>test</code></p>'
+        )
+        fp.close()
+
+    def test_mapping_closed_after_compile(self):
+        fp = self._path('`test`')
+        md = Markdown.from_path(fp.name)
+        self.assertTrue(isinstance(md.input, mmap.mmap))
+        md.get_html_content()
+        self.assertRaises(ValueError, md.input.__getitem__, 0)
+        fp.close()
+
+    def test_empty_file(self):
+        fp = self._path('')
+        self.assertEqual(Markdown.from_path(fp.name).get_html_content(), '')
+        fp.close()
+
+
+class OutputBufferTestCase(unittest.TestCase):
+    def test_get_html_content_buffer(self):
+        buf = Markdown('`test`').get_html_content_buffer()
+        self.assertEqual(buf.raw, '<p><code>test</code></p>')
+        self.assertEqual(memoryview(buf).tobytes(), buf.raw)
+
+    def test_buffer_keeps_document_alive(self):
+        md = Markdown('`test`')
+        buf = md.get_html_content_buffer()
+        doc = md._doc
+        del md
+        self.assertEqual(doc.contents.compiled, 1)
+        self.assertEqual(buf.raw, '<p><code>test</code></p>')
+
+    def test_empty_buffer(self):
+        self.assertEqual(Markdown('').get_html_content_buffer().raw, '')
+
+    def test_render_into(self):
+        html = '<p><code>test</code></p>'
+
+        buf = bytearray(64)
+        self.assertEqual(Markdown('`test`').render_into(buf), len(html))
+        self.assertEqual(str(buf[:len(html)]), html)
+
+        buf = bytearray(64)
+        ln = Markdown('`test`').render_into(memoryview(buf)[10:])
+        self.assertEqual(str(buf[10:10 + ln]), html)
+
+    def test_render_into_too_small(self):
+        self.assertRaises(
+            ValueError, Markdown('`test`').render_into, bytearray(4))
+
+
+class StreamingOutputTestCase(unittest.TestCase):
+    text = '<style>p {}</style>\n\n# header-1\n\n`test`'
+
+    def test_write_to_writer(self):
+        md = Markdown(self.text)
+        for method, getter in [
+            (md.write_html_content, md.get_html_content),
+            (md.write_html_toc, md.get_html_toc),
+            (md.write_html_css, md.get_html_css),
+        ]:
+            o = StringIO.StringIO()
+            method(o)
+            self.assertEqual(o.getvalue(), getter())
+
+    def test_write_to_fd(self):
+        r, w = os.pipe()
+        Markdown('`test`').write_html_content(w)
+        os.close(w)
+        self.assertEqual(os.read(r, 1024), '<p><code>test</code></p>')
+        os.close(r)
+
+    def test_write_in_chunks(self):
+        writes = []
+
+        class Writer(object):
+            def write(self, data):
+                writes.append(data)
+
+        md = Markdown('`test`\n\n' * 20000)
+        md.write_html_content(Writer())
+        self.assertTrue(len(writes) > 1)
+        self.assertTrue(
+            all(len(data) <= discount.WRITE_CHUNK_SIZE for data in writes))
+        self.assertEqual(''.join(writes), md.get_html_content())
+
+    def test_iter_html_content(self):
+        md = Markdown('`test`')
+        self.assertEqual(
+            list(md.iter_html_content(chunk_size=10)),
+            ['<p><code>t', 'est</code>', '</p>']
+        )
+        self.assertEqual(list(Markdown('').iter_html_content()), [])
+
+
+class RenderInlineTestCase(unittest.TestCase):
+    def test_render_inline(self):
+        self.assertEqual(render_inline('`test`'), '<code>test</code>')
+        self.assertEqual(
+            render_inline('*a* [b](/b.html)'),
+            '<em>a</em> <a href="/b.html">b</a>'
+        )
+
+    def test_no_block_processing(self):
+        self.assertEqual(render_inline('# test'), '# test')
+
+    def test_empty(self):
+        self.assertEqual(render_inline(''), '')
+
+    def test_kwargs_flags(self):
+        self.assertEqual(
+            render_inline('<b>a</b>', ignore_embedded_html=True),
+            '&lt;b>a&lt;/b>'
+        )
+
+    def test_render_inline_many(self):
+        texts = ['`test`', '', '*a*', 'b']
+        self.assertEqual(
+            render_inline_many(texts),
+            [render_inline(text) for text in texts]
+        )
+
+
+class RenderManyTestCase(unittest.TestCase):
+    def test_matches_markdown_class(self):
+        texts = ['`test`', '*a*', '', '# b', '[c](http://example.com/)']
+        self.assertEqual(
+            list(render_many(texts, workers=2)),
+            [Markdown(text).get_html_content() for text in texts]
+        )
+
+    def test_preserves_order(self):
+        texts = ['%d' % i for i in range(500)]
+        self.assertEqual(
+            list(render_many(iter(texts), workers=4, chunksize=3)),
+            ['<p>%d</p>' % i for i in range(500)]
+        )
+
+    def test_kwargs_flags(self):
+        texts = ['<b>a</b>', 'http://example.com/']
+        self.assertEqual(
+            list(render_many(texts, ignore_embedded_html=True, autolink=True)),
+            [Markdown(text, ignore_embedded_html=True, autolink=True)
+             .get_html_content() for text in texts]
+        )
+
+    def test_empty_iterable(self):
+        self.assertEqual(list(render_many([])), [])
+
+
+class RendererTestCase(unittest.TestCase):
+    def test_unknown_keyword_argument(self):
+        self.assertRaises(TypeError, Renderer, autolinks=True)
+
+    def test_false_options_are_ignored(self):
+        renderer = Renderer(autolink=True, toc=False)
+        self.assertEqual(renderer.flags, libmarkdown.MKD_AUTOLINK)
+        self.assertEqual(renderer.options, frozenset(['autolink']))
+
+    def test_configuration_is_frozen(self):
+        renderer = Renderer(autolink=True)
+        self.assertRaises(AttributeError, setattr, renderer, 'flags', 0)
+
+    def test_ignore_header(self):
+        text = '% title\n% author\n\n`test`'
+        with Renderer(autolink=True) as renderer:
+            self.assertEqual(
+                renderer.render(text),
+                Markdown(text, autolink=True).get_html_content())
+
+            expected = Markdown(
+                text, autolink=True, ignore_header=True).get_html_content()
+            self.assertEqual(
+                renderer.render(text, ignore_header=True), expected)
+            self.assertEqual(
+                list(renderer.render_many([text], ignore_header=True)),
+                [expected])
+            self.assertEqual(renderer.flags, libmarkdown.MKD_AUTOLINK)
+
+    def test_render(self):
+        renderer = Renderer(autolink=True)
+        self.assertEqual(
+            renderer.render('http://example.com/'),
+            Markdown('http://example.com/', autolink=True).get_html_content()
+        )
+
+    def test_render_with_callbacks(self):
+        renderer = Renderer(
+            rewrite_links_func=add_basepath, cache=RenderCache())
+        for _ in range(2):
+            self.assertEqual(
+                renderer.render('[a](/a.html)'),
+                '<p><a href="http://example.com/a.html">a</a></p>'
+            )
+        self.assertEqual(renderer.cache.hits, 1)
+
+    def test_render_inline(self):
+        renderer = Renderer(ignore_embedded_html=True)
+        self.assertEqual(
+            renderer.render_inline('*<b>a</b>*'),
+            '<em>&lt;b>a&lt;/b></em>'
+        )
+
+    def test_render_file(self):
+        fp = tempfile.NamedTemporaryFile(suffix='.md')
+        fp.write('[a](/a.html)')
+        fp.flush()
+
+        renderer = Renderer(rewrite_links_func=add_basepath)
+        self.assertEqual(
+            renderer.render_file(fp.name),
+            '<p><a href="http://example.com/a.html">a</a></p>'
+        )
+        fp.close()
+
+    def test_render_many(self):
+        texts = ['[%d](/%d.html)' % (i, i) for i in range(200)]
+        with Renderer(rewrite_links_func=add_basepath, workers=4) as renderer:
+            self.assertEqual(
+                list(renderer.render_many(texts, chunksize=3)),
+                [renderer.render(text) for text in texts]
+            )
+
+    def test_per_thread_resources(self):
+        renderer = Renderer()
+        arena = renderer._resources().arena
+        self.assertTrue(renderer._resources().arena is arena)
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(renderer._resources().arena))
+        thread.start()
+        thread.join()
+        self.assertFalse(other[0] is arena)
+
+    def test_render_reuses_arena(self):
+        renderer = Renderer(rewrite_links_func=add_basepath)
+        renderer.render('[a](/a.html)')
+        block = renderer._resources().arena._block
+        renderer.render('[b](/b.html)')
+        self.assertTrue(block is not None)
+        self.assertTrue(renderer._resources().arena._block is block)
+
+    def test_shared_between_threads(self):
+        renderer = Renderer(rewrite_links_func=add_basepath)
+        results = []
+
+        def render():
+            for i in range(100):
+                results.append(
+                    renderer.render('[a](/%d.html)' % i) ==
+                    '<p><a href="http://example.com/%d.html">a</a></p>' % i)
+
+        threads = [threading.Thread(target=render) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 400)
+
+
+class SplitBlocksTestCase(unittest.TestCase):
+    def test_paragraphs(self):
+        self.assertEqual(
+            split_blocks('# a\n\nb\nc\n\n\nd\n'), ['# a', 'b\nc', 'd'])
+
+    def test_lists_and_quotes_are_not_split(self):
+        self.assertEqual(
+            split_blocks(
+                '* a\n\n* b\n\n    code\n\n1. c\n\n> d\n\n> e\n\nf'),
+            ['* a\n\n* b\n\n    code\n\n1. c', '> d\n\n> e', 'f']
+        )
+
+    def test_html_blocks(self):
+        self.assertEqual(
+            split_blocks('a\n<div>\n<div>\n\n</div>\n\nb\n</div>\nc'),
+            ['a', '<div>\n<div>\n\n</div>\n\nb\n</div>', 'c']
+        )
+        self.assertEqual(
+            split_blocks('a\n\n<div>\n\nb'), ['a', '<div>\n\nb'])
+        self.assertEqual(
+            split_blocks('<div>\n\nb', libmarkdown.MKD_NOHTML),
+            ['<div>', 'b']
+        )
+
+    def test_comments_in_html_blocks(self):
+        self.assertEqual(
+            split_blocks(
+                '<div>\n<!-- </div> -->\n\ntext\n\n</div>\n\nafter'),
+            ['<div>\n<!-- </div> -->\n\ntext\n\n</div>', 'after']
+        )
+        self.assertEqual(
+            split_blocks('<div>\n<!--\n</div>\n-->\n</div>\nafter'),
+            ['<div>\n<!--\n</div>\n-->\n</div>', 'after']
+        )
+
+    def test_references(self):
+        text = (
+            'a [b][Some  Ref]\n[some\tref]: /b\n  "Title"\n\nc\n\n'
+            '[x]: /x =10x20\n\n    [code]: /code\n'
+        )
+        self.assertEqual(
+            split_blocks(text), ['a [b][Some  Ref]\nc\n\n    [code]: /code'])
+        self.assertEqual(
+            find_references(text),
+            [('some ref', '[some\tref]: /b\n  "Title"'),
+             ('x', '[x]: /x =10x20')]
+        )
+
+
+class IncrementalDocumentTestCase(unittest.TestCase):
+    text = (
+        '# Title\n\n'
+        'A [link][ref].\n\n'
+        '* a\n* b\n\n'
+        'Last paragraph.\n\n'
+        '[ref]: http://example.com/\n'
+    )
+
+    def test_html_matches_markdown(self):
+        doc = IncrementalDocument(self.text)
+        self.assertEqual(doc.html, Markdown(self.text).get_html_content())
+        self.assertEqual(len(doc.blocks), 4)
+        self.assertEqual(doc.rendered, 4)
+        self.assertTrue(all(block.changed for block in doc.blocks))
+
+    def test_only_changed_blocks_are_rendered(self):
+        doc = IncrementalDocument(self.text)
+        ids = [block.id for block in doc.blocks]
+
+        text = self.text.replace('* b', '* b\n* c')
+        blocks = doc.update(text)
+        self.assertEqual(doc.rendered, 1)
+        self.assertEqual([block.id for block in blocks], ids)
+        self.assertEqual(
+            [block.changed for block in blocks], [False, False, True, False])
+        self.assertEqual(doc.html, Markdown(text).get_html_content())
+
+    def test_reference_changes(self):
+        doc = IncrementalDocument(self.text)
+        text = self.text.replace('example.com', 'example.org')
+        blocks = doc.update(text)
+        self.assertEqual(doc.rendered, 1)
+        self.assertEqual(
+            [block.changed for block in blocks], [False, True, False, False])
+        self.assertEqual(doc.html, Markdown(text).get_html_content())
+
+    def test_unclosed_html_gets_no_definitions(self):
+        text = '[x]: /x\n\n<div>\nsee [x]'
+        doc = IncrementalDocument(text)
+        self.assertEqual(doc.html, Markdown(text).get_html_content())
+        self.assertFalse('[x]: /x' in doc.html)
+
+    def test_inserted_and_removed_blocks(self):
+        doc = IncrementalDocument(self.text)
+        ids = [block.id for block in doc.blocks]
+
+        blocks = doc.update(self.text.replace(
+            '# Title\n\n', '# Title\n\nNew paragraph.\n\n'))
+        self.assertEqual(doc.rendered, 1)
+        self.assertEqual(
+            [block.id for block in blocks],
+            [ids[0], max(ids) + 1] + ids[1:]
+        )
+
+        blocks = doc.update(self.text.replace('Last paragraph.\n\n', ''))
+        self.assertEqual(doc.rendered, 0)
+        self.assertEqual(doc.removed, [max(ids) + 1, ids[3]])
+
+
+# Building blocks of the documents ``render_sharded`` is checked on.
+SHARDING_SNIPPETS = [
+    '% Title\n% Author\n% Date',
+    '# Header',
+    'Setext header\n=============',
+    'A paragraph with *emphasis*, `code` and a [link](/a.html).',
+    'A [reference][Ref One] and [another] [two], lazily\ncontinued.',
+    '[ref one]: http://example.com/one "One"',
+    '[Two]: http://example.com/two\n    "Two"',
+    '[another]: /another =10x20',
+    '* item\n* item\n\n* loose item\n\n    continued',
+    '1. first\n2. second\n\n    code in a list',
+    '> quote\n\n> quote again\nlazy',
+    '    indented code\n\n    more code',
+    '<div>\nhtml *block*\n\n[ref one]: not a definition\n</div>',
+    '<!-- a\n\ncomment -->',
+    '<div>\n<!-- </div> -->\n\ntext\n\n</div>',
+    '<style>\np { color: red; }\n</style>',
+    '---',
+    'a | b\n--|--\n1 | 2',
+    'A paragraph\n[inline]: /inline\n\nswallowed blank lines.',
+    'http://example.com/ and <http://example.com/auto>',
+]
+
+
+def sharding_corpus():
+    rng = random.Random(1)
+    documents = []
+    for path in ['README.rst', 'RELEASES', 'INSTALL']:
+        fp = open(os.path.join(os.path.dirname(__file__), path))
+        documents.append(fp.read())
+        fp.close()
+    for _ in range(50):
+        snippets = [rng.choice(SHARDING_SNIPPETS) for _ in range(30)]
+        separators = [rng.choice(['\n\n', '\n\n\n', '\n']) for _ in snippets]
+        documents.append(''.join(
+            snippet + separator
+            for snippet, separator in zip(snippets, separators)))
+    documents.append(SHARDING_SNIPPETS[-1] + '\n\n<div>\nnever closed')
+    return documents
+
+
+class ShardedRenderingTestCase(unittest.TestCase):
+    def assertSameOutput(self, **kwargs):
+        with Renderer(workers=4, **kwargs) as renderer:
+            for text in sharding_corpus():
+                self.assertEqual(
+                    render_sharded(text, renderer, shard_size=1),
+                    Markdown(text, **kwargs).get_html_content(),
+                    text
+                )
+                self.assertEqual(
+                    render_sharded(text, renderer, shard_size=200),
+                    Markdown(text, **kwargs).get_html_content(),
+                    text
+                )
+
+    def test_corpus(self):
+        self.assertSameOutput()
+
+    def test_corpus_with_flags(self):
+        self.assertSameOutput(toc=True, autolink=True)
+        self.assertSameOutput(ignore_embedded_html=True)
+        self.assertSameOutput(ignore_header=True)
+
+    def test_corpus_with_callbacks(self):
+        self.assertSameOutput(rewrite_links_func=add_basepath)
+
+    def test_large_document(self):
+        text = '\n\n'.join(sharding_corpus()[3:]) * 20
+        self.assertEqual(
+            render_sharded(text, shard_size=64 * 1024, workers=4),
+            Markdown(text).get_html_content()
+        )
+
+
+class CorpusRendererTestCase(unittest.TestCase):
+    def test_render(self):
+        texts = ['%d `test`' % i for i in range(300)]
+        with CorpusRenderer(processes=2, chunksize=7) as renderer:
+            self.assertEqual(
+                list(renderer.render(texts)),
+                [Markdown(text).get_html_content() for text in texts]
+            )
+
+    def test_render_with_callbacks(self):
+        texts = ['[a](/a.html)', '[b](http://example.org/b.html)']
+        with CorpusRenderer(processes=2,
+                            rewrite_links_func=add_basepath) as renderer:
+            self.assertEqual(
+                list(renderer.render(texts)),
+                [Markdown(text, rewrite_links_func=add_basepath)
+                 .get_html_content() for text in texts]
+            )
+
+    def test_render_files(self):
+        files = []
+        for i in range(10):
+            fp = tempfile.NamedTemporaryFile()
+            fp.write('*%d*' % i)
+            fp.flush()
+            files.append(fp)
+
+        with CorpusRenderer(processes=2, chunksize=3) as renderer:
+            self.assertEqual(
+                list(renderer.render_files(fp.name for fp in files)),
+                ['<p><em>%d</em></p>' % i for i in range(10)]
+            )
+
+        for fp in files:
+            fp.close()
+
+    def test_worker_stats(self):
+        texts = ['`test`'] * 100
+        with CorpusRenderer(processes=2, chunksize=10) as renderer:
+            list(renderer.render(texts))
+
+        stats = renderer.worker_stats.values()
+        self.assertTrue(1 <= len(stats) <= 2)
+        self.assertEqual(sum(s.documents for s in stats), 100)
+        self.assertEqual(sum(s.bytes for s in stats), 600)
+        for s in stats:
+            self.assertTrue(s.throughput > 0)
+
+
+class RenderCacheTestCase(unittest.TestCase):
+    def test_lru_bounded_by_bytes(self):
+        cache = RenderCache(max_bytes=10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        cache.set('c', 'cccc')
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.get('c'), 'cccc')
+        self.assertEqual(cache.stats(), {
+            'hits': 3, 'misses': 1, 'evictions': 1,
+            'entries': 2, 'bytes': 8, 'max_bytes': 10,
+        })
+
+    def test_oversized_values_are_not_cached(self):
+        cache = RenderCache(max_bytes=3)
+        cache.set('a', 'aaaa')
+        self.assertEqual(len(cache), 0)
+
+    def test_markdown_hits(self):
+        cache = RenderCache()
+        html = Markdown('`test`', cache=cache).get_html_content()
+        self.assertEqual(html, '<p><code>test</code></p>')
+        self.assertEqual(
+            Markdown('`test`', cache=cache).get_html_content(), html)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        Markdown('# a', cache=cache).get_html_toc()
+        Markdown('# a', cache=cache).get_html_toc()
+        Markdown('<style>p {}</style>', cache=cache).get_html_css()
+        Markdown('<style>p {}</style>', cache=cache).get_html_css()
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+    def test_toc_flag_set_on_hit(self):
+        cache = RenderCache()
+        cold = Markdown('# a', cache=cache)
+        cold.get_html_toc()
+        cold_html = cold.get_html_content()
+
+        warm = Markdown('# a', cache=cache)
+        warm.get_html_toc()
+        self.assertEqual(warm.flags & libmarkdown.MKD_TOC,
+                         libmarkdown.MKD_TOC)
+        self.assertEqual(warm.get_html_content(), cold_html)
+        self.assertTrue('id=' in cold_html)
+
+    def test_key_uses_compile_flags(self):
+        # The document is compiled without table-of-contents headers,
+        # so its parts must not be cached as those of ``toc=True``.
+        cache = RenderCache()
+        md = Markdown('# a', cache=cache)
+        md.get_html_content()
+        md.get_html_toc()
+        md.get_html_content()
+
+        expected = Markdown('# a', toc=True)
+        md = Markdown('# a', cache=cache, toc=True)
+        self.assertEqual(md.get_html_toc(), expected.get_html_toc())
+        self.assertEqual(md.get_html_content(), expected.get_html_content())
+
+    def test_key_includes_flags_and_callbacks(self):
+        cache = RenderCache()
+        Markdown('[a](/a.html)', cache=cache).get_html_content()
+        Markdown('[a](/a.html)', cache=cache,
+                 ignore_links=True).get_html_content()
+        html = Markdown('[a](/a.html)', cache=cache,
+                        rewrite_links_func=add_basepath).get_html_content()
+
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        self.assertEqual(
+            html, '<p><a href="http://example.com/a.html">a</a></p>')
+
+    def test_define_tag_invalidates(self):
+        cache = RenderCache()
+        Markdown('`test`', cache=cache).get_html_content()
+        discount.define_tag('x-cache-test')
+        Markdown('`test`', cache=cache).get_html_content()
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_file_input_is_not_cached(self):
+        cache = RenderCache()
+        i = tempfile.TemporaryFile('r+w')
+        i.write('`test`')
+        i.seek(0)
+        Markdown(i, cache=cache).get_html_content()
+        i.close()
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+
+
+class MemoizedLinkCallbackTestCase(unittest.TestCase):
+    def test_memoizes(self):
+        calls = []
+
+        def callback(url):
+            calls.append(url)
+            if url.startswith('/'):
+                return 'http://example.com%s' % url
+
+        callback = MemoizedLinkCallback(callback)
+        text = '[a](/a.html) [b](/a.html) [c](http://example.org/)'
+
+        for _ in range(3):
+            html = Markdown(
+                text, rewrite_links_func=callback).get_html_content()
+            self.assertEqual(
+                html,
+                '<p><a href="http://example.com/a.html">a</a> '
+                '<a href="http://example.com/a.html">b</a> '
+                '<a href="http://example.org/">c</a></p>'
+            )
+
+        self.assertEqual(calls, ['/a.html', 'http://example.org/'])
+        stats = callback.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (7, 2))
+        self.assertAlmostEqual(stats['hit_rate'], 7 / 9.0)
+
+    def test_reuses_buffers(self):
+        callback = MemoizedLinkCallback(add_basepath)
+        self.assertTrue(
+            callback.buffer_for('/a.html') is callback.buffer_for('/a.html'))
+        self.assertEqual(callback('/a.html'), 'http://example.com/a.html')
+        self.assertEqual(callback('http://example.org/'), None)
+
+    def test_bounded(self):
+        callback = MemoizedLinkCallback(add_basepath, max_entries=2)
+        for url in ['/a', '/b', '/a', '/c', '/b']:
+            callback(url)
+        self.assertEqual((callback.hits, callback.misses), (1, 4))
+        self.assertEqual(callback.stats()['entries'], 2)
+
+    def test_link_attrs(self):
+        def add_target_blank(url):
+            return 'target="_blank"'
+
+        callback = MemoizedLinkCallback(add_target_blank)
+        md = Markdown('[a](/a.html)', link_attrs_func=callback)
+        self.assertEqual(
+            md.get_html_content(),
+            '<p><a href="/a.html" target="_blank">a</a></p>'
+        )
+
+
+class LinkRulesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rules = LinkRules(
+            prefixes={
+                '/media/': 'http://cdn.example.com/media/',
+                '/media/big/': 'http://big.example.com/',
+            },
+            force_https=True,
+            allow_hosts=['example.com'],
+            deny_hosts=['evil.example.org'],
+            external_attrs='rel="nofollow" target="_blank"',
+        )
+
+    def test_rewrite(self):
+        rewrite = self.rules.rewrite
+        self.assertEqual(
+            rewrite('/media/a.png'), 'https://cdn.example.com/media/a.png')
+        self.assertEqual(
+            rewrite('/media/big/a.png'), 'https://big.example.com/a.png')
+        self.assertEqual(rewrite('http://a.org/'), 'https://a.org/')
+        self.assertEqual(rewrite('https://a.org/'), None)
+        self.assertEqual(rewrite('/a.html'), None)
+        self.assertEqual(rewrite('http://www.evil.example.org/'), '#')
+
+    def test_attributes(self):
+        attributes = self.rules.attributes
+        external = 'rel="nofollow" target="_blank"'
+        self.assertEqual(attributes('/a.html'), None)
+        self.assertEqual(attributes('/media/a.png'), None)
+        self.assertEqual(attributes('http://www.example.com/'), None)
+        self.assertEqual(attributes('http://example.org/'), external)
+        self.assertEqual(attributes('http://evil.example.org/'), None)
+
+    def test_attribute_templates(self):
+        rules = LinkRules(attrs='data-host="{host}" data-url="{url}"')
+        self.assertEqual(
+            rules.attributes('http://a.org/?a="b"'),
+            'data-host="a.org" data-url="http://a.org/?a=&quot;b&quot;"'
+        )
+        self.assertEqual(rules.rewrite_links_func, None)
+
+    def test_stable_cache_key(self):
+        rules = LinkRules(force_https=True)
+        other = LinkRules(force_https=True)
+        self.assertEqual(
+            discount.cache._callback_identity(rules.rewrite_links_func),
+            discount.cache._callback_identity(other.rewrite_links_func),
+        )
+
+    def test_markdown(self):
+        md = Markdown(
+            '[a](/media/a.png) [b](http://example.org/)',
+            link_rules=self.rules
+        )
+        self.assertEqual(
+            md.get_html_content(),
+            '<p><a href="https://cdn.example.com/media/a.png">a</a> '
+            '<a href="https://example.org/" rel="nofollow" target="_blank">'
+            'b</a></p>'
+        )
+
+    def test_markdown_with_callbacks(self):
+        self.assertRaises(
+            TypeError, Markdown, '', link_rules=self.rules,
+            rewrite_links_func=add_basepath
+        )
+
+
+class DiskCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_shared_between_instances(self):
+        cache = DiskCache(self.path)
+        html = Markdown('`test`', cache=cache).get_html_content()
+
+        cache = DiskCache(self.path)
+        self.assertEqual(
+            Markdown('`test`', cache=cache).get_html_content(), html)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_eviction(self):
+        cache = DiskCache(self.path, max_bytes=10)
+        cache.set(('a',), 'aaaa')
+        cache.set(('b',), 'bbbb')
+        self.assertEqual(cache.get(('a',)), 'aaaa')
+        cache.set(('c',), 'cccc')
+
+        self.assertEqual(cache.get(('b',)), None)
+        self.assertEqual(cache.get(('a',)), 'aaaa')
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual((stats['entries'], stats['bytes']), (2, 8))
+
+    def test_hits_do_not_wait_for_writers(self):
+        cache = DiskCache(self.path, timeout=5.0)
+        cache.set(('a',), 'aaaa')
+        self.assertEqual(
+            cache._connect().execute('PRAGMA synchronous').fetchone()[0], 1)
+
+        writer = sqlite3.connect(
+            os.path.join(self.path, 'render-cache.sqlite'),
+            isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        try:
+            start = time.time()
+            for i in xrange(200):
+                self.assertEqual(cache.get(('a',)), 'aaaa')
+            self.assertTrue(time.time() - start < 1.0)
+        finally:
+            writer.execute('ROLLBACK')
+            writer.close()
+
+        # The access times are written along with the next entry.
+        cache.set(('b',), 'bbbb')
+        self.assertEqual(cache._local.atimes, {})
+
+    def test_callbacks(self):
+        cache = DiskCache(self.path)
+        Markdown('[a](/a.html)', cache=cache,
+                 rewrite_links_func=add_basepath).get_html_content()
+        Markdown('[a](/a.html)', cache=cache,
+                 rewrite_links_func=lambda url: url).get_html_content()
+        self.assertEqual(len(cache), 1)
+
+
 if __name__ == '__main__':
     unittest.main()